@@ -0,0 +1,301 @@
+"""Нагрузочный стенд бота склада без Google и Telegram.
+
+Подменяет таблицу на FakeSpreadsheet в памяти (с искусственной задержкой
+и ошибками 429), генерирует поддельные сообщения и нажатия кнопок и
+прогоняет через настоящие обработчики bot.py поиск, добавление, перенос,
+удаление и просмотр логов на складах разного размера.
+
+    python bench.py                          # 1k, 10k, 100k строк
+    python bench.py --sizes 10000 --ops 500 --latency-ms 150 --error-rate 0.05
+    python bench.py --backend sqlite > bench_output.txt
+
+Для каждой операции печатает p50/p99 времени обработчика, число запросов
+к Sheets на операцию (с учётом отложенной записи) и пропускную способность.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import gspread
+
+import bot
+
+
+class FakeResponse:
+    """Ответ HTTP, из которого gspread собирает APIError"""
+
+    def __init__(self, code, message):
+        self.status_code = code
+        self.text = message
+        self._json = {"error": {"code": code, "message": message, "status": "RESOURCE_EXHAUSTED"}}
+
+    def json(self):
+        return self._json
+
+
+class FakeSpreadsheet:
+    """Таблица в памяти с интерфейсом gspread, которым пользуется бот.
+
+    latency — задержка каждого запроса в секундах, error_rate — доля
+    запросов, которые падают с 429, calls — счётчик запросов по методам.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self.sheet1 = FakeWorksheet(self, 0, "Sheet1")
+        self.logs = FakeWorksheet(self, 1, "Logs")
+
+    def request(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise gspread.exceptions.APIError(FakeResponse(429, "Quota exceeded"))
+
+    def worksheet(self, title):
+        return self.logs if title == "Logs" else self.sheet1
+
+    def batch_update(self, body):
+        self.request("batch_update")
+        for request in body["requests"]:
+            if "deleteDimension" in request:
+                r = request["deleteDimension"]["range"]
+                del self._by_id(r["sheetId"]).values[r["startIndex"]:r["endIndex"]]
+            elif "updateCells" in request:
+                r = request["updateCells"]["range"]
+                ws = self._by_id(r["sheetId"])
+                value = request["updateCells"]["rows"][0]["values"][0]["userEnteredValue"]["stringValue"]
+                row = ws.values[r["startRowIndex"]]
+                row.extend([""] * (r["startColumnIndex"] + 1 - len(row)))
+                row[r["startColumnIndex"]] = value
+        return {"replies": []}
+
+    def _by_id(self, sheet_id):
+        return self.sheet1 if sheet_id == self.sheet1.id else self.logs
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, sheet_id, title):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self.values = []
+
+    def get_all_values(self):
+        self.spreadsheet.request("get_all_values")
+        return [list(row) for row in self.values]
+
+    def update(self, range_name, values):
+        self.spreadsheet.request("update")
+        if not self.values:
+            self.values.append([])
+        self.values[0] = list(values[0])
+
+    def append_rows(self, rows, value_input_option=None):
+        self.spreadsheet.request("append_rows")
+        first = len(self.values) + 1
+        self.values.extend([str(x) for x in row] for row in rows)
+        return {"updates": {"updatedRange": f"{self.title}!A{first}:E{len(self.values)}"}}
+
+    def batch_get(self, ranges):
+        self.spreadsheet.request("batch_get")
+        result = []
+        for a1 in ranges:
+            match = re.match(r"A(\d+):E(\d*)", a1)
+            first = int(match.group(1))
+            last = int(match.group(2)) if match.group(2) else len(self.values)
+            result.append([list(row) for row in self.values[first - 1:last]])
+        return result
+
+
+class FakeMessage:
+    def __init__(self, text=None):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def reply_document(self, document, **kwargs):
+        self.replies.append(kwargs.get("filename"))
+
+
+class FakeQuery:
+    def __init__(self, data, user):
+        self.data = data
+        self.from_user = user
+        self.message = FakeMessage()
+        self.edits = []
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+def fake_user(user_id):
+    return SimpleNamespace(id=user_id, username=f"bench{user_id}")
+
+def text_update(text, user_id):
+    return SimpleNamespace(message=FakeMessage(text), callback_query=None, effective_user=fake_user(user_id))
+
+def callback_update(data, user_id):
+    user = fake_user(user_id)
+    return SimpleNamespace(message=None, callback_query=FakeQuery(data, user), effective_user=user)
+
+def fake_context(**user_data):
+    return SimpleNamespace(user_data=dict(user_data), args=[])
+
+
+def shelves():
+    return [shelf for row in bot.SHELF_LAYOUT for shelf in row]
+
+def fill(fake, size):
+    """size пружин и столько же строк журнала со случайными номерами"""
+    numbers = [str(random.randint(10_000, 10_000 + size * 2)) for _ in range(size)]
+    fake.sheet1.values = [["Номер", "Полка", "Дата добавления"]] + [
+        [number, random.choice(shelves()), "2026-01-01 10:00"] for number in numbers
+    ]
+    fake.logs.values = [["Время", "ID", "Пользователь", "Действие", "Номер"]] + [
+        ["2026-01-01 10:00:00", "1", "bench", "🔍 искал: ", random.choice(numbers)] for _ in range(size)
+    ]
+    return numbers
+
+
+def random_record():
+    return random.choice([r for r in bot.spring_index.rows[-500:] if r['number']] or bot.spring_index.rows)
+
+def make_op(name, numbers, user_id):
+    """(обработчик, update, context) для одной операции"""
+    if name == "search":
+        return bot.handle_text_message, text_update(random.choice(numbers), user_id), fake_context()
+    if name == "add":
+        data = bot.cb("add_confirm", number=str(random.randint(1, 10**6)), shelf=random.choice(shelves()))
+        return bot.callback_handler, callback_update(data, user_id), fake_context()
+    if name == "move":
+        data = bot.cb("move_confirm", record_id=random_record()['id'], shelf=random.choice(shelves()))
+        return bot.callback_handler, callback_update(data, user_id), fake_context()
+    if name == "delete":
+        data = bot.cb("del_select", record_id=random_record()['id'])
+        return bot.callback_handler, callback_update(data, user_id), fake_context()
+    if name == "logs":
+        return bot.handle_text_message, text_update(random.choice(numbers), user_id), fake_context(logs_mode=True)
+    raise ValueError(name)
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+async def run_scenario(fake, name, numbers, ops, concurrency):
+    """Гоняет ops операций name по concurrency штук одновременно"""
+    latencies = []
+    calls_before = sum(fake.calls.values())
+    queue = list(range(ops))
+
+    async def worker(worker_id):
+        while queue:
+            i = queue.pop()
+            handler, update, context = make_op(name, numbers, worker_id * 1000 + i)
+            started = time.perf_counter()
+            await handler(update, context)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    # Отложенная запись — тоже цена операции
+    await bot.sheet_writer.flush()
+    await bot.log_writer.flush()
+    elapsed = time.perf_counter() - started
+    return {
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "calls": (sum(fake.calls.values()) - calls_before) / ops,
+        "throughput": ops / elapsed,
+    }
+
+
+async def run_size(size, args):
+    fake = FakeSpreadsheet()
+    numbers = fill(fake, size)
+    bot.google.spreadsheet, bot.google.sheet, bot.google.logs_sheet = fake, fake.sheet1, fake.logs
+    if args.backend == "sqlite":
+        db = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        db.close()
+        bot.storage = bot.SQLiteStorage(db.name)
+    bot.spring_index.ready = False
+    bot.log_index.ready = False
+    bot.log_history_cache.items.clear()
+
+    started = time.perf_counter()
+    await bot.warm_up()
+    await bot.log_index.stop()  # хвост логов в стенде не нужен
+    warm_up = time.perf_counter() - started
+
+    # Задержка и ошибки — только после прогрева, чтобы он не растягивался
+    fake.latency = args.latency_ms / 1000
+    fake.error_rate = args.error_rate
+    results = {}
+    for name in args.scenarios:
+        results[name] = await run_scenario(fake, name, numbers, args.ops, args.concurrency)
+    fake.latency = 0
+    fake.error_rate = 0
+    bot.sheets_io.breaker.success()
+    # Всё, что не ушло из-за ошибок 429, дописываем до следующего размера
+    while bot.sheet_writer.pending or bot.log_writer.buffer:
+        await bot.sheet_writer.flush()
+        await bot.log_writer.flush()
+
+    if args.backend == "sqlite":
+        bot.storage.close()
+        os.remove(db.name)
+    return warm_up, results
+
+
+async def main(args):
+    bot.rate_limiter = bot.RateLimiter(burst=10**9, rate=10**9)
+    bot.log_writer.spill_path = os.path.join(tempfile.gettempdir(), "bench_logs_spill.jsonl")
+    bot.sheet_writer.journal_path = os.path.join(tempfile.gettempdir(), "bench_sheet_journal.jsonl")
+    bot.INDEX_SNAPSHOT_FILE = os.path.join(tempfile.gettempdir(), "bench_springs_snapshot.json")
+    print(f"backend={args.backend} ops={args.ops} concurrency={args.concurrency} "
+          f"latency={args.latency_ms}ms error_rate={args.error_rate}")
+    for size in args.sizes:
+        warm_up, results = await run_size(size, args)
+        print(f"\n== {size} строк (прогрев {warm_up * 1000:.0f} мс) ==")
+        print(f"{'операция':<10}{'p50, мс':>10}{'p99, мс':>10}{'Sheets/оп':>12}{'оп/с':>10}")
+        for name, r in results.items():
+            print(f"{name:<10}{r['p50']:>10.3f}{r['p99']:>10.3f}{r['calls']:>12.3f}{r['throughput']:>10.0f}")
+    bot.sheets_io.shutdown()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        type=lambda s: [int(x) for x in s.split(",")])
+    parser.add_argument("--ops", type=int, default=200, help="операций каждого вида на размер")
+    parser.add_argument("--concurrency", type=int, default=1, help="одновременных пользователей")
+    parser.add_argument("--latency-ms", type=float, default=0, help="задержка каждого запроса к Sheets")
+    parser.add_argument("--error-rate", type=float, default=0, help="доля запросов, падающих с 429")
+    parser.add_argument("--backend", choices=["sheets", "sqlite"], default="sheets")
+    parser.add_argument("--scenarios", default="search,add,move,delete,logs", type=lambda s: s.split(","))
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    asyncio.run(main(args))
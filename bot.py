@@ -1,7 +1,21 @@
+import asyncio
+import bisect
+import functools
 import logging
 import os
 import json
+import random
 import base64
+import contextlib
+import csv
+import gzip
+import io
+import re
+import secrets
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import gspread
@@ -23,36 +37,333 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Метрики
+class Metrics:
+    """Счётчики и гистограммы времени в памяти, отдаются в формате Prometheus.
+
+    Запись — пара операций со словарём, так что метрики можно держать
+    включёнными всегда.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}    # (имя, метки) → значение
+        self.histograms = {}  # (имя, метки) → [счётчики по корзинам..., сумма]
+        self.gauges = {}      # имя → функция, которая возвращает значение
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+        histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def count(self, name, **labels):
+        """Сумма счётчика по всем меткам, которые совпадают с labels"""
+        wanted = set(labels.items())
+        return sum(value for (n, l), value in self.counters.items() if n == name and wanted <= set(l))
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+    def render(self):
+        """Текст для /metrics (Prometheus exposition format)"""
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), histogram[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram[-1]:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for name, func in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {func()}")
+        lines.append("# TYPE bot_uptime_seconds gauge")
+        lines.append(f"bot_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+
+    def timings(self, name, label):
+        """{значение метки label: (число, среднее в мс)} для /stats"""
+        result = {}
+        for (n, labels), histogram in self.histograms.items():
+            if n == name:
+                count = sum(histogram[:-1])
+                result[dict(labels).get(label, "")] = (count, histogram[-1] / count * 1000)
+        return result
+
+
+metrics = Metrics()
+
+def timed(name):
+    """Время работы обработчика → bot_handler_seconds{handler=name}"""
+    def decorate(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                metrics.inc("bot_handler_errors_total", handler=name)
+                raise
+            finally:
+                metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name)
+        return wrapper
+    return decorate
+
 # Скоупы Google API
 scope = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive",
 ]
 
-# Декодируем credentials
-encoded_creds = os.environ["GOOGLE_CREDENTIALS_B64"]
-decoded_creds = base64.b64decode(encoded_creds).decode("utf-8")
-service_account_info = json.loads(decoded_creds)
-
-# Авторизация
-creds = Credentials.from_service_account_info(service_account_info, scopes=scope)
-client = gspread.authorize(creds)
-
-# Таблицы
-spreadsheet = client.open_by_url(
+SPREADSHEET_URL = os.getenv(
+    "SPREADSHEET_URL",
     "https://docs.google.com/spreadsheets/d/1-PYvDusEahk2EYI2f4kDtu4uQ-pV756kz6fb_RXn-s8"
 )
-sheet = spreadsheet.sheet1
-logs_sheet = spreadsheet.worksheet("Logs")
 
-# Инициализация структуры
-def init_sheet():
+# Вызовы gspread блокирующие, поэтому из async-кода они идут через пул потоков
+SHEETS_MAX_WORKERS = int(os.getenv("SHEETS_MAX_WORKERS", "4"))
+SHEETS_CALL_TIMEOUT = float(os.getenv("SHEETS_CALL_TIMEOUT", "30"))
+# Повторы при 429/5xx: до SHEETS_RETRIES раз, пауза случайная в [0, base·2ⁿ], не больше max
+SHEETS_RETRIES = int(os.getenv("SHEETS_RETRIES", "3"))
+SHEETS_BACKOFF_BASE = float(os.getenv("SHEETS_BACKOFF_BASE", "0.5"))
+SHEETS_BACKOFF_MAX = float(os.getenv("SHEETS_BACKOFF_MAX", "10"))
+# После CIRCUIT_FAILURES неудачных вызовов подряд запросы к Google приостанавливаются
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "5"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))
+CIRCUIT_MAX_COOLDOWN = float(os.getenv("CIRCUIT_MAX_COOLDOWN", "600"))
+
+RETRY_STATUSES = {"429", "500", "502", "503", "504"}
+
+def sheets_error_status(error):
+    """HTTP-код ошибки gspread (429, 500...) или имя исключения"""
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    return str(status) if status else type(error).__name__
+
+def retry_after(error):
+    """Пауза из заголовка Retry-After в секундах или 0"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
     try:
-        sheet.update('A1', [['Номер', 'Полка', 'Дата добавления']])
-    except:
-        pass
+        return float(headers.get("Retry-After", 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+class SheetsUnavailable(Exception):
+    """Google Sheets не отвечает: цепь разомкнута, запрос не отправлялся"""
+
+
+class CircuitBreaker:
+    """Размыкает цепь после threshold неудачных вызовов подряд.
+
+    Пока цепь разомкнута, вызовы сразу получают SheetsUnavailable и не
+    тратят квоту. Через cooldown секунд пропускается один пробный вызов:
+    удачный замыкает цепь, неудачный размыкает её снова на вдвое больший срок.
+    """
+
+    def __init__(self, threshold, cooldown, max_cooldown):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None  # time.monotonic() размыкания
+        self._probing = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        """True, если это пробный вызов; SheetsUnavailable, если звонить нельзя"""
+        if self.opened_at is None:
+            return False
+        if self._probing or time.monotonic() - self.opened_at < self.cooldown:
+            raise SheetsUnavailable("Google Sheets временно недоступен")
+        self._probing = True
+        return True
+
+    def abandon_probe(self):
+        """Пробный вызов отменён, не дождавшись ответа: следующий вызов проверит снова"""
+        self._probing = False
+
+    def success(self, probe=False):
+        if self.opened_at is not None:
+            logger.info("✅ Google Sheets снова отвечает")
+        self.failures = 0
+        self.opened_at = None
+        self.cooldown = self.base_cooldown
+        self._probing = False
+
+    def failure(self, probe=False):
+        self.failures += 1
+        if probe:
+            self._probing = False
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.opened_at = time.monotonic()
+            logger.warning(f"🛑 Google Sheets всё ещё не отвечает, следующая проверка через {self.cooldown:.0f} с")
+        elif self.opened_at is None and self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            metrics.inc("bot_sheets_circuit_opened_total")
+            logger.error(
+                f"🛑 Google Sheets не отвечает ({self.failures} ошибок подряд), "
+                f"запросы приостановлены на {self.cooldown:.0f} с"
+            )
+
+
+class SheetsExecutor:
+    """Выполняет блокирующие вызовы gspread вне event loop.
+
+    Не больше max_workers запросов к Google одновременно, каждый вызов
+    ограничен по времени; обработчики и другие чаты при этом не ждут.
+    Ответы 429/5xx (у записей — только 429) повторяются с паузой со случайным разбросом, а после
+    серии неудач CircuitBreaker перестаёт пускать запросы, чтобы повторы
+    не добивали исчерпанную квоту. Таймауты не повторяются: запрос мог
+    дойти, и повторный append_rows задвоил бы строки.
+    """
+
+    def __init__(self, max_workers, timeout, retries, breaker):
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = breaker
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="sheets")
+        self._semaphore = asyncio.Semaphore(max_workers)
+
+    async def _call_once(self, method, func, args, kwargs, timeout):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            metrics.inc("bot_sheets_calls_total", method=method)
+            try:
+                future = loop.run_in_executor(self._pool, functools.partial(func, *args, **kwargs))
+                return await asyncio.wait_for(future, timeout or self.timeout)
+            except Exception as e:
+                metrics.inc("bot_sheets_errors_total", method=method, status=sheets_error_status(e))
+                raise
+            finally:
+                metrics.observe("bot_sheets_call_seconds", time.perf_counter() - started, method=method)
+
+    async def call(self, func, *args, timeout=None, idempotent=True, **kwargs):
+        """await sheets_io.call(ws.get_all_values) — как ws.get_all_values(), но в пуле.
+
+        idempotent=False — для записей (append_rows, batch_update с номерами
+        строк): 5xx мог прийти уже после того, как запрос применился, и повтор
+        задвоил бы строки или удалил соседнюю. Такие вызовы повторяются только
+        при 429 — его Google не применяет.
+        """
+        method = getattr(func, "__name__", "call").lstrip("_")
+        for attempt in range(self.retries + 1):
+            probe = self.breaker.before_call()
+            try:
+                result = await self._call_once(method, func, args, kwargs, timeout)
+            except asyncio.CancelledError:
+                if probe:
+                    self.breaker.abandon_probe()
+                raise
+            except Exception as e:
+                status = sheets_error_status(e)
+                if isinstance(e, gspread.exceptions.GSpreadException) and status not in RETRY_STATUSES:
+                    # Google ответил — ошибка в самом запросе, а не в доступности
+                    self.breaker.success(probe)
+                    raise
+                retryable = status == "429" or (idempotent and status in RETRY_STATUSES)
+                if not retryable or probe or attempt == self.retries:
+                    self.breaker.failure(probe)
+                    raise
+                delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** attempt))
+                delay = min(max(delay, retry_after(e)), SHEETS_BACKOFF_MAX)
+                metrics.inc("bot_sheets_retries_total", method=method, status=status)
+                logger.warning(f"Sheets {method}: {status}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.success(probe)
+                return result
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+sheets_io = SheetsExecutor(
+    SHEETS_MAX_WORKERS, SHEETS_CALL_TIMEOUT, SHEETS_RETRIES,
+    CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_COOLDOWN, CIRCUIT_MAX_COOLDOWN),
+)
+
+class SheetsConnection:
+    """Подключение к таблице, которое открывается при первом обращении.
+
+    Авторизация и открытие листов — несколько запросов к Google, поэтому
+    они не выполняются при импорте: бот сразу начинает принимать сообщения,
+    а таблица подключается из фоновых задач (await google.get()).
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.spreadsheet = None
+        self.sheet = None
+        self.logs_sheet = None
+        self._lock = asyncio.Lock()
+
+    def _connect(self):
+        # Декодируем credentials
+        decoded_creds = base64.b64decode(os.environ["GOOGLE_CREDENTIALS_B64"]).decode("utf-8")
+        service_account_info = json.loads(decoded_creds)
+
+        # Авторизация
+        creds = Credentials.from_service_account_info(service_account_info, scopes=scope)
+        client = gspread.authorize(creds)
+
+        # Таблицы
+        spreadsheet = client.open_by_url(self.url)
+        sheet = spreadsheet.sheet1
+        logs_sheet = spreadsheet.worksheet("Logs")
+
+        # Инициализация структуры
+        try:
+            sheet.update('A1', [['Номер', 'Полка', 'Дата добавления']])
+        except gspread.exceptions.APIError as e:
+            logger.error(f"Ошибка записи заголовка: {e}")
+
+        self.spreadsheet, self.sheet, self.logs_sheet = spreadsheet, sheet, logs_sheet
+        logger.info("📗 Таблица подключена")
+
+    async def get(self):
+        async with self._lock:
+            if self.spreadsheet is None:
+                await sheets_io.call(self._connect)
+        return self
 
-init_sheet()
+
+google = SheetsConnection(SPREADSHEET_URL)
 
 def format_date(date_str):
     """Форматирует дату ДД.ММ.ГГГГ ЧЧ:ММ"""
@@ -67,24 +378,1218 @@ def format_date(date_str):
         except:
             return '❓ нет даты'
 
+def shelf_key(shelf):
+    """Полки «a1» и «A1» — одна и та же полка"""
+    return str(shelf).strip().upper()
+
+class SpringIndex:
+    """Индекс склада в памяти: номер → строки, полка → строки.
+
+    Загружается из таблицы один раз при старте и дальше обновляется
+    собственными записями бота, поэтому поиск не ходит в Sheets.
+    Отсортированный список номеров (numbers) нужен для поиска по началу
+    номера и подсказок «возможно, ты искал».
+    У каждой записи есть постоянный id: кнопки ссылаются на него, а номер
+    строки (row_index) индекс пересчитывает сам, когда строки сдвигаются.
+    """
+
+    def __init__(self):
+        self.rows = []       # записи в порядке строк таблицы, начиная со стр. 2
+        self.by_id = {}      # id → запись
+        self.by_number = {}  # номер → [записи]
+        self.by_shelf = {}   # полка (shelf_key) → [записи]
+        self.numbers = []    # различные номера по возрастанию
+        self.alphabet = set()  # символы, из которых состоят номера
+        self._next_id = 1
+        self._loading = False
+        self.ready = False   # True после первой загрузки
+        self.snapshot_time = None  # время снимка, если индекс загружен не из таблицы
+        self.resyncing = False     # идёт сверка с таблицей (resync_inventory)
+
+    def load(self, all_values, db_ids=None):
+        """Строит индекс по результату get_all_values().
+
+        db_ids — ключи строк в локальном хранилище (SQLite), по одному на строку.
+        """
+        self.rows = []
+        self.by_id = {}
+        self.by_number = {}
+        self.by_shelf = {}
+        self.numbers = []
+        self.alphabet = set()
+        self._loading = True
+        for i, values in enumerate(all_values[1:]):
+            record = self._append(
+                values[0] if len(values) > 0 else '',
+                values[1] if len(values) > 1 else '',
+                values[2] if len(values) > 2 else '',
+            )
+            if db_ids is not None:
+                record['db_id'] = db_ids[i]
+        self._loading = False
+        self.numbers = sorted(self.by_number)
+        for number in self.numbers:
+            self.alphabet.update(number)
+        self.ready = True
+        self.snapshot_time = None
+        logger.info(f"📦 Индекс склада загружен: {len(self.rows)} строк")
+
+    @property
+    def read_only(self):
+        """Индекс из локального снимка или сверяется с таблицей: искать можно, менять нельзя"""
+        return self.snapshot_time is not None or self.resyncing
+
+    def snapshot(self):
+        """Содержимое склада для локального снимка"""
+        return {
+            'time': datetime.now().strftime("%Y-%m-%d %H:%M"),
+            'rows': [[r['number'], r['shelf'], r['add_date']] for r in self.rows],
+        }
+
+    def load_snapshot(self, data):
+        """Загружает снимок, когда таблица недоступна; строки в нём могут быть устаревшими"""
+        self.load([['Номер', 'Полка', 'Дата добавления']] + data['rows'])
+        self.snapshot_time = data['time']
+
+    def _append(self, number, shelf, add_date):
+        record = {
+            'id': self._next_id,
+            'row_index': len(self.rows) + 2,
+            'db_id': None,
+            'number': str(number).strip(),
+            'shelf': str(shelf).strip(),
+            'add_date': add_date,
+        }
+        self._next_id += 1
+        self.rows.append(record)
+        self.by_id[record['id']] = record
+        if record['number']:
+            if record['number'] not in self.by_number and not self._loading:
+                bisect.insort(self.numbers, record['number'])
+                self.alphabet.update(record['number'])
+            self.by_number.setdefault(record['number'], []).append(record)
+            self.by_shelf.setdefault(shelf_key(record['shelf']), []).append(record)
+        return record
+
+    @staticmethod
+    def _discard(bucket, key, record):
+        records = bucket.get(key)
+        if records is None:
+            return
+        # Списки упорядочены по row_index — ищем бинарным поиском, а не сравнением словарей
+        position = bisect.bisect_left(records, record['row_index'], key=lambda r: r['row_index'])
+        while records[position] is not record:
+            position += 1
+        del records[position]
+        if not records:
+            del bucket[key]
+
+    def get(self, record_id):
+        """Запись по id или None, если её уже удалили"""
+        return self.by_id.get(record_id)
+
+    def find(self, number):
+        return list(self.by_number.get(number.strip(), []))
+
+    def with_prefix(self, prefix, limit):
+        """Номера, начинающиеся с prefix (бинарный поиск по numbers)"""
+        result = []
+        position = bisect.bisect_left(self.numbers, prefix)
+        while position < len(self.numbers) and len(result) < limit:
+            number = self.numbers[position]
+            if not number.startswith(prefix):
+                break
+            result.append(number)
+            position += 1
+        return result
+
+    def near(self, number, limit):
+        """Номера на расстоянии одной правки: пропущен, лишний, заменён или переставлен символ"""
+        candidates = set()
+        for i in range(len(number) + 1):
+            head, tail = number[:i], number[i:]
+            if tail:
+                candidates.add(head + tail[1:])
+            if len(tail) > 1:
+                candidates.add(head + tail[1] + tail[0] + tail[2:])
+            for char in self.alphabet:
+                candidates.add(head + char + tail)
+                if tail:
+                    candidates.add(head + char + tail[1:])
+        candidates.discard(number)
+        return sorted(c for c in candidates if c in self.by_number)[:limit]
+
+    def suggest(self, query, limit=6):
+        """Подсказки для ненайденного номера: сначала по началу, потом похожие"""
+        query = query.strip()
+        if not query:
+            return []
+        result = [n for n in self.with_prefix(query, limit + 1) if n != query][:limit]
+        for number in self.near(query, limit):
+            if len(result) >= limit:
+                break
+            if number not in result:
+                result.append(number)
+        return result
+
+    def on_shelf(self, shelf):
+        """Пружины на полке в порядке строк таблицы"""
+        return self.by_shelf.get(shelf_key(shelf), [])
+
+    def shelf_counts(self):
+        """Полка → сколько на ней пружин (списки ведутся при каждом изменении)"""
+        return {shelf: len(records) for shelf, records in self.by_shelf.items()}
+
+    def add(self, number, shelf, add_date):
+        """Учитывает строку, дописанную в конец таблицы"""
+        return self._append(number, shelf, add_date)
+
+    def set_shelf(self, record, shelf):
+        """Учитывает перенос записи на другую полку"""
+        if record['number']:
+            self._discard(self.by_shelf, shelf_key(record['shelf']), record)
+            members = self.by_shelf.setdefault(shelf_key(shelf), [])
+            bisect.insort(members, record, key=lambda r: r['row_index'])
+        record['shelf'] = shelf
+
+    def delete(self, records):
+        """Учитывает удаление записей за один проход: строки ниже сдвигаются вверх"""
+        doomed = {r['id'] for r in records if r['id'] in self.by_id}
+        if not doomed:
+            return
+        first = min(self.by_id[record_id]['row_index'] for record_id in doomed) - 2
+        kept = self.rows[:first]
+        shift = 0
+        for record in self.rows[first:]:
+            if record['id'] in doomed:
+                shift += 1
+                del self.by_id[record['id']]
+                if record['number']:
+                    self._discard(self.by_number, record['number'], record)
+                    self._discard(self.by_shelf, shelf_key(record['shelf']), record)
+                    if record['number'] not in self.by_number:
+                        position = bisect.bisect_left(self.numbers, record['number'])
+                        if position < len(self.numbers) and self.numbers[position] == record['number']:
+                            del self.numbers[position]
+                continue
+            record['row_index'] -= shift
+            kept.append(record)
+        self.rows = kept
+
+
+spring_index = SpringIndex()
+
+# Отложенная запись в таблицу
+SHEET_FLUSH_INTERVAL = int(os.getenv("SHEET_FLUSH_MS", "500")) / 1000
+SHEET_FLUSH_MAX_OPS = int(os.getenv("SHEET_FLUSH_MAX_OPS", "50"))
+SHEET_JOURNAL_FILE = os.getenv("SHEET_JOURNAL_FILE", "sheet_journal.jsonl")
+# Что таблица отвергла насовсем (400, 403...), чтобы не повторять это вечно
+SHEET_DEAD_LETTER_FILE = os.getenv("SHEET_DEAD_LETTER_FILE", "sheet_dead_letter.jsonl")
+
+class BackgroundFlusher:
+    """Фоновая задача, которая вызывает flush() раз в interval секунд
+    или раньше, если её разбудили через _wakeup"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _cancel(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def stop(self):
+        """Останавливает фоновую задачу и делает последний flush()"""
+        await self._cancel()
+        await self.flush()
+
+
+def parse_updated_rows(response):
+    """(первая, последняя) строка из ответа values_append или None"""
+    try:
+        updated_range = response['updates']['updatedRange']
+    except (KeyError, TypeError):
+        return None
+    match = re.search(r"!\$?[A-Z]+\$?(\d+)(?::\$?[A-Z]+\$?(\d+))?$", updated_range)
+    if not match:
+        return None
+    first = int(match.group(1))
+    return first, int(match.group(2) or first)
+
+def is_rejected(error):
+    """Google ответил и отказал: повтор того же запроса ничего не изменит"""
+    return isinstance(error, gspread.exceptions.GSpreadException) and sheets_error_status(error) not in RETRY_STATUSES
+
+def dead_letter(kind, items, error):
+    """Откладывает операции или строки журнала, которые нельзя отправить, в SHEET_DEAD_LETTER_FILE"""
+    entry = {
+        'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'kind': kind,
+        'error': str(error),
+        'items': items,
+    }
+    with open(SHEET_DEAD_LETTER_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    metrics.inc("bot_sheet_dead_letters_total", len(items), kind=kind)
+    logger.error(f"☠️ Не записано в таблицу: {len(items)} ({kind}), {error}. Сохранено в {SHEET_DEAD_LETTER_FILE}")
+
+class SheetWriter(BackgroundFlusher):
+    """Очередь изменений склада с пакетной отправкой в Google Sheets.
+
+    Обработчики сразу обновляют индекс и кладут операцию в очередь, а
+    фоновая задача раз в SHEET_FLUSH_INTERVAL секунд (или при накоплении
+    SHEET_FLUSH_MAX_OPS операций) отправляет их одним-двумя запросами.
+    Порядок операций сохраняется: подряд идущие добавления уходят одним
+    values_append, подряд идущие переносы и удаления — одним batch_update.
+
+    Если запись не удалась, очередь сохраняется в журнал journal_path, и
+    пока таблица недоступна, новые операции дописываются туда же: после
+    перезапуска они не теряются (см. replay_sheet_journal).
+    """
+
+    def __init__(self, connection, interval, max_ops, journal_path):
+        super().__init__(interval)
+        self.connection = connection
+        self.max_ops = max_ops
+        self.journal_path = journal_path
+        self.journaled = False  # очередь целиком лежит в журнале
+        self.pending = []
+        self.misplaced_appends = 0
+        self.out_of_sync = False  # номера строк в индексе и таблице разошлись
+        self._lock = asyncio.Lock()
+
+    def _enqueue(self, op):
+        self.pending.append(op)
+        if self.journaled:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(op, ensure_ascii=False) + "\n")
+        if len(self.pending) >= self.max_ops:
+            self._wakeup.set()
+
+    def _save_journal(self):
+        with open(self.journal_path, "w", encoding="utf-8") as f:
+            for op in self.pending:
+                f.write(json.dumps(op, ensure_ascii=False) + "\n")
+        self.journaled = True
+
+    def _clear_journal(self):
+        if self.journaled and os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journaled = False
+
+    def read_journal(self):
+        """Операции, которые не дошли до таблицы до перезапуска"""
+        if not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path, encoding="utf-8") as f:
+            return [tuple(json.loads(line)) for line in f if line.strip()]
+
+    def add(self, rows, first_row):
+        """Строки для добавления в конец листа — одна операция на пачку.
+
+        first_row — строка, на которую они должны лечь по данным индекса.
+        """
+        self._enqueue(('add', rows, first_row))
+
+    def move(self, row_index, shelf):
+        self._enqueue(('move', row_index, shelf))
+
+    def delete(self, row_index):
+        self._enqueue(('delete', row_index))
+
+    def _request(self, op, sheet_id):
+        """Операция переноса/удаления → запрос spreadsheets.batchUpdate"""
+        if op[0] == 'move':
+            _, row_index, shelf = op
+            return {"updateCells": {
+                "range": {
+                    "sheetId": sheet_id,
+                    "startRowIndex": row_index - 1, "endRowIndex": row_index,
+                    "startColumnIndex": 1, "endColumnIndex": 2,
+                },
+                "rows": [{"values": [{"userEnteredValue": {"stringValue": shelf}}]}],
+                "fields": "userEnteredValue",
+            }}
+        _, row_index = op
+        return {"deleteDimension": {"range": {
+            "sheetId": sheet_id, "dimension": "ROWS",
+            "startIndex": row_index - 1, "endIndex": row_index,
+        }}}
+
+    def _requests(self, group, sheet_id):
+        """Запросы batchUpdate; удаления соседних строк сливаются в один диапазон"""
+        requests = []
+        for op in group:
+            request = self._request(op, sheet_id)
+            previous = requests[-1].get("deleteDimension") if requests else None
+            current = request.get("deleteDimension")
+            if previous and current:
+                start = current["range"]["startIndex"]
+                if start == previous["range"]["startIndex"]:
+                    # та же позиция — следующая строка исходного диапазона
+                    previous["range"]["endIndex"] += 1
+                    continue
+                if start == previous["range"]["startIndex"] - 1:
+                    # строка прямо над диапазоном (удаление снизу вверх)
+                    previous["range"]["startIndex"] = start
+                    continue
+            requests.append(request)
+        return requests
+
+    def _check_position(self, response, expected):
+        """Сверяет, куда лёг append, с номером строки из индекса"""
+        rows = parse_updated_rows(response)
+        if rows and rows[0] != expected:
+            self.misplaced_appends += 1
+            self.out_of_sync = True
+            logger.warning(
+                f"⚠️ Строки легли на стр. {rows[0]} вместо {expected}: номера строк в боте "
+                f"разошлись с таблицей, переносы и удаления приостановлены до сверки"
+            )
+
+    @staticmethod
+    def _group(ops):
+        """Разбивает очередь на подряд идущие группы: добавления / остальное"""
+        groups = []
+        for op in ops:
+            kind = 'add' if op[0] == 'add' else 'batch'
+            if groups and groups[-1][0] == kind:
+                groups[-1][1].append(op)
+            else:
+                groups.append((kind, [op]))
+        return groups
+
+    async def flush(self):
+        """Отправляет накопленные операции; при сбое они остаются в очереди,
+        а отвергнутые таблицей группы уходят в dead_letter"""
+        async with self._lock:
+            if not self.pending:
+                return
+            ops, self.pending = self.pending, []
+            groups = self._group(ops)
+            for i, (kind, group) in enumerate(groups):
+                if self.out_of_sync and kind == 'batch':
+                    # Номера строк в этих операциях — по индексу, который с таблицей уже не совпадает
+                    dead_letter("sheet", group, "номера строк разошлись с таблицей")
+                    continue
+                try:
+                    conn = await self.connection.get()
+                    if kind == 'add':
+                        response = await sheets_io.call(
+                            conn.sheet.append_rows, [row for op in group for row in op[1]],
+                            value_input_option='RAW', idempotent=False,
+                        )
+                        self._check_position(response, group[0][2])
+                    else:
+                        await sheets_io.call(
+                            conn.spreadsheet.batch_update, {"requests": self._requests(group, conn.sheet.id)},
+                            idempotent=False,
+                        )
+                except Exception as e:
+                    if is_rejected(e):
+                        # Иначе эта группа навсегда застрянет в голове очереди вместе со всем, что за ней
+                        dead_letter("sheet", group, e)
+                        self.out_of_sync = True
+                        continue
+                    if kind == 'batch' and not isinstance(e, SheetsUnavailable) and sheets_error_status(e) != "429":
+                        # 5xx или таймаут: запрос мог примениться, повтор удалил бы соседнюю строку
+                        dead_letter("sheet", group, f"неизвестно, применилось ли: {e}")
+                        self.out_of_sync = True
+                        continue
+                    if not isinstance(e, SheetsUnavailable):
+                        logger.error(f"Ошибка записи в таблицу ({len(group)} операций): {e}")
+                    unsent = [op for _, rest in groups[i:] for op in rest]
+                    self.pending = unsent + self.pending
+                    # Журнал дописывается в _enqueue; переписываем, только если часть ушла
+                    if i > 0 or not self.journaled:
+                        self._save_journal()
+                    return
+            if not self.pending:
+                self._clear_journal()
+            elif self.journaled:
+                # Отправленное из журнала убираем, пришедшее во время записи — оставляем
+                self._save_journal()
+        if self.out_of_sync:
+            schedule_resync()
+
+    async def stop(self):
+        await super().stop()
+        if self.pending:
+            self._save_journal()
+            logger.error(f"❌ Не записано в таблицу: {len(self.pending)} операций, сохранены в {self.journal_path}")
+
+
+sheet_writer = SheetWriter(google, SHEET_FLUSH_INTERVAL, SHEET_FLUSH_MAX_OPS, SHEET_JOURNAL_FILE)
+
+# Журнал действий
+LOG_FLUSH_INTERVAL = int(os.getenv("LOG_FLUSH_MS", "2000")) / 1000
+LOG_BUFFER_MAX = int(os.getenv("LOG_BUFFER_MAX", "500"))
+LOG_SPILL_FILE = os.getenv("LOG_SPILL_FILE", "logs_spill.jsonl")
+
+LOG_HISTORY_KEEP = int(os.getenv("LOG_HISTORY_KEEP", "5"))
+LOG_TAIL_INTERVAL = int(os.getenv("LOG_TAIL_SECONDS", "60"))
+LOGS_PAGE_SIZE = 5
+
+# Старые поиски сжатие журнала сворачивает в одну строку «🔍 искал ×N»
+SEARCH_ACTION = "🔍 искал"
+SEARCH_ROLLUP = re.compile(r"^🔍 искал ×(\d+)")
+
+def log_weight(action):
+    """Сколько действий в строке журнала: N для счётчика поисков, иначе 1"""
+    rollup = SEARCH_ROLLUP.match(action)
+    return int(rollup.group(1)) if rollup else 1
+
+class LogIndex(BackgroundFlusher):
+    """Индекс журнала: по каждому номеру — последние keep записей и общее число.
+
+    Строится одним чтением листа Logs при старте; свои записи бот добавляет
+    сразу из log_action, а строки, дописанные в лист кем-то ещё, фоновая
+    задача раз в LOG_TAIL_INTERVAL секунд дочитывает с конца листа.
+    """
+
+    def __init__(self, connection, keep, interval):
+        super().__init__(interval)
+        self.connection = connection
+        self.keep = keep
+        self.ready = False
+        self.recent = {}     # номер → [записи], новые первыми
+        self.counts = {}     # номер → всего записей
+        self.rows_seen = 1   # строк листа уже учтено (с заголовком)
+        self.gaps = []       # чужие строки между нашими пачками: [(первая, последняя)]
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def _entry(row):
+        if not row or len(row) < 5:
+            return None
+        return {
+            'timestamp': str(row[0]),
+            'user_id': str(row[1]),
+            'username': str(row[2]),
+            'action': str(row[3]),
+            'number': str(row[4]).strip(),
+        }
+
+    def _index(self, row):
+        entry = self._entry(row)
+        if entry is None:
+            return
+        number = entry['number']
+        entries = self.recent.setdefault(number, [])
+        entries.append(entry)
+        entries.sort(key=lambda x: x['timestamp'], reverse=True)
+        del entries[self.keep:]
+        self.counts[number] = self.counts.get(number, 0) + log_weight(entry['action'])
+
+    def load(self, all_logs):
+        self.recent = {}
+        self.counts = {}
+        self.gaps = []
+        for row in all_logs[1:]:
+            self._index(row)
+        self.rows_seen = max(len(all_logs), 1)
+        self.ready = True
+        logger.info(f"📋 Индекс логов загружен: {self.rows_seen - 1} строк")
+
+    def add(self, row):
+        """Учитывает строку журнала, ещё не записанную в таблицу"""
+        self._index(row)
+
+    def mark_written(self, response):
+        """Сдвигает хвост после нашего append_rows; пропущенные строки — в gaps"""
+        rows = parse_updated_rows(response)
+        if rows is None:
+            return
+        first, last = rows
+        if first > self.rows_seen + 1:
+            self.gaps.append((self.rows_seen + 1, first - 1))
+        self.rows_seen = max(self.rows_seen, last)
+
+    def reset_tail(self, rows):
+        """Лист переписан заново (сжатие журнала): в нём теперь rows строк"""
+        self.rows_seen = max(rows, 1)
+        self.gaps = []
+
+    async def stop(self):
+        # Дочитывать хвост при остановке незачем
+        await self._cancel()
+
+    def history(self, number):
+        """(последние записи, всего записей) без обращения к таблице"""
+        number = number.strip()
+        return list(self.recent.get(number, [])), self.counts.get(number, 0)
+
+    async def flush(self):
+        """Дочитывает строки, которые появились в листе не через этого бота"""
+        async with self.lock:
+            ranges = [f"A{first}:E{last}" for first, last in self.gaps]
+            ranges.append(f"A{self.rows_seen + 1}:E")
+            try:
+                conn = await self.connection.get()
+                results = await sheets_io.call(conn.logs_sheet.batch_get, ranges)
+            except Exception as e:
+                if not isinstance(e, SheetsUnavailable):
+                    logger.error(f"Ошибка чтения хвоста логов: {e}")
+                return
+            self.gaps = []
+            for values in results:
+                for row in values:
+                    self._index(row)
+            self.rows_seen += len(results[-1])
+
+
+log_index = LogIndex(google, LOG_HISTORY_KEEP, LOG_TAIL_INTERVAL)
+
+class LogWriter(BackgroundFlusher):
+    """Буфер журнала действий с пакетной записью в лист Logs.
+
+    log_action только кладёт строку в буфер; фоновая задача раз в
+    LOG_FLUSH_INTERVAL секунд дописывает всё одним append_rows. Если
+    Sheets недоступен, строки сбрасываются в локальный файл LOG_SPILL_FILE
+    и дописываются в таблицу при следующем удачном flush.
+    """
+
+    def __init__(self, connection, index, interval, max_size, spill_path):
+        super().__init__(interval)
+        self.connection = connection
+        self.index = index
+        self.max_size = max_size
+        self.spill_path = spill_path
+        self.buffer = []
+
+    def add(self, row):
+        self.index.add(row)
+        self.buffer.append(row)
+        if len(self.buffer) >= self.max_size:
+            self._wakeup.set()
+
+    def _read_spill(self):
+        if not os.path.exists(self.spill_path):
+            return []
+        with open(self.spill_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _write_spill(self, rows):
+        with open(self.spill_path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    async def flush(self):
+        # Общая блокировка с LogIndex: хвост не читается посреди нашей записи
+        async with self.index.lock:
+            spilled = self._read_spill()
+            rows, self.buffer = spilled + self.buffer, []
+            if not rows:
+                return
+            try:
+                conn = await self.connection.get()
+                response = await sheets_io.call(
+                    conn.logs_sheet.append_rows, rows, value_input_option='RAW', idempotent=False
+                )
+            except Exception as e:
+                if is_rejected(e):
+                    dead_letter("logs", rows, e)
+                    if spilled:
+                        os.remove(self.spill_path)
+                    return
+                if not isinstance(e, SheetsUnavailable):
+                    logger.error(f"Ошибка лога ({len(rows)} строк сохранено в {self.spill_path}): {e}")
+                self._write_spill(rows)
+                return
+            self.index.mark_written(response)
+            if spilled:
+                os.remove(self.spill_path)
+
+
+log_writer = LogWriter(google, log_index, LOG_FLUSH_INTERVAL, LOG_BUFFER_MAX, LOG_SPILL_FILE)
+
+# Основное хранилище склада и журнала
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sheets")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "springs.db")
+
+class SheetsStorage:
+    """Основное хранилище — сама Google-таблица.
+
+    Изменения в таблицу и так уходят через sheet_writer/log_writer,
+    поэтому здесь записывать нечего.
+    """
+
+    name = "sheets"
+
+    async def load_inventory(self):
+        """(строки как в get_all_values(), ключи строк или None)"""
+        conn = await google.get()
+        return await sheets_io.call(conn.sheet.get_all_values), None
+
+    async def load_logs(self):
+        conn = await google.get()
+        return await sheets_io.call(conn.logs_sheet.get_all_values)
+
+    def add(self, records):
+        pass
+
+    def move(self, record):
+        pass
+
+    def delete(self, records):
+        pass
+
+    def log_many(self, rows):
+        pass
+
+    def logs_for(self, number):
+        """Вся история номера или None, если её надо читать из таблицы"""
+        return None
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage(SheetsStorage):
+    """Основное хранилище — локальная база SQLite, таблица — её зеркало.
+
+    Порядок строк в springs (по id) совпадает с порядком строк листа, поэтому
+    позиции в индексе остаются позициями в таблице. При первом запуске
+    пустая база заполняется из таблицы; дальше таблица только догоняет
+    базу через очереди sheet_writer/log_writer и может отставать при сбоях
+    Google, не мешая работе бота.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS springs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                number TEXT NOT NULL,
+                shelf TEXT NOT NULL,
+                add_date TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS springs_number ON springs (number);
+            CREATE INDEX IF NOT EXISTS springs_shelf ON springs (shelf);
+            CREATE TABLE IF NOT EXISTS logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                username TEXT NOT NULL,
+                action TEXT NOT NULL,
+                number TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS logs_number ON logs (number, timestamp);
+        """)
+        self.conn.commit()
+
+    def _is_empty(self, table):
+        return self.conn.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {table})").fetchone()[0]
+
+    async def load_inventory(self):
+        if self._is_empty("springs"):
+            all_values, _ = await super().load_inventory()
+            self.conn.executemany(
+                "INSERT INTO springs (number, shelf, add_date) VALUES (?, ?, ?)",
+                [(str(v[0]).strip() if len(v) > 0 else '',
+                  str(v[1]).strip() if len(v) > 1 else '',
+                  v[2] if len(v) > 2 else '') for v in all_values[1:]],
+            )
+            self.conn.commit()
+            logger.info(f"🗄️ Склад перенесён из таблицы в {SQLITE_PATH}")
+        rows = self.conn.execute("SELECT id, number, shelf, add_date FROM springs ORDER BY id").fetchall()
+        return [['Номер', 'Полка', 'Дата добавления']] + [list(r[1:]) for r in rows], [r[0] for r in rows]
+
+    async def load_logs(self):
+        if self._is_empty("logs"):
+            all_logs = await super().load_logs()
+            self.conn.executemany(
+                "INSERT INTO logs (timestamp, user_id, username, action, number) VALUES (?, ?, ?, ?, ?)",
+                [[str(x) for x in row[:5]] for row in all_logs[1:] if len(row) >= 5],
+            )
+            self.conn.commit()
+            logger.info(f"🗄️ Логи перенесены из таблицы в {SQLITE_PATH}")
+        rows = self.conn.execute(
+            "SELECT timestamp, user_id, username, action, number FROM logs ORDER BY id"
+        ).fetchall()
+        return [['Время', 'ID', 'Пользователь', 'Действие', 'Номер']] + [list(r) for r in rows]
+
+    def add(self, records):
+        for record in records:
+            cursor = self.conn.execute(
+                "INSERT INTO springs (number, shelf, add_date) VALUES (?, ?, ?)",
+                (record['number'], record['shelf'], record['add_date']),
+            )
+            record['db_id'] = cursor.lastrowid
+        self.conn.commit()
+
+    def move(self, record):
+        self.conn.execute("UPDATE springs SET shelf = ? WHERE id = ?", (record['shelf'], record['db_id']))
+        self.conn.commit()
+
+    def delete(self, records):
+        self.conn.executemany("DELETE FROM springs WHERE id = ?", [(r['db_id'],) for r in records])
+        self.conn.commit()
+
+    def log_many(self, rows):
+        self.conn.executemany(
+            "INSERT INTO logs (timestamp, user_id, username, action, number) VALUES (?, ?, ?, ?, ?)",
+            [[str(x) for x in row[:4]] + [str(row[4]).strip()] for row in rows],
+        )
+        self.conn.commit()
+
+    def logs_for(self, number):
+        rows = self.conn.execute(
+            "SELECT timestamp, user_id, username, action, number FROM logs "
+            "WHERE number = ? ORDER BY timestamp DESC",
+            (number.strip(),),
+        ).fetchall()
+        return [
+            {'timestamp': r[0], 'user_id': r[1], 'username': r[2], 'action': r[3], 'number': r[4]}
+            for r in rows
+        ]
+
+    def close(self):
+        self.conn.close()
+
+
+if STORAGE_BACKEND == "sqlite":
+    storage = SQLiteStorage(SQLITE_PATH)
+else:
+    storage = SheetsStorage()
+
+# Сжатие журнала: старые записи — в архив, старые поиски — в счётчики
+LOG_ARCHIVE_DAYS = int(os.getenv("LOG_ARCHIVE_DAYS", "90"))
+LOG_COMPACT_INTERVAL = float(os.getenv("LOG_COMPACT_HOURS", "24")) * 3600
+LOG_ARCHIVE = os.getenv("LOG_ARCHIVE", "sheets")  # sheets — листы «Logs 2026-01», gzip — файлы
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "logs_archive")
+
+LOG_TIMESTAMP = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+def compact_log_rows(all_logs, cutoff):
+    """Делит лист Logs по времени cutoff ("%Y-%m-%d %H:%M:%S").
+
+    Возвращает (номера старых строк листа, строки-счётчики поисков,
+    {месяц: строки в архив}, оставшиеся строки). Старые поиски каждого
+    номера вместе с прошлым счётчиком сворачиваются в одну строку
+    «🔍 искал ×N» с временем последнего поиска; строки без даты не трогаются.
+    """
+    old_rows, archive, kept, searches = [], {}, [], {}
+    for position, row in enumerate(all_logs[1:], 2):
+        row = [str(x) for x in row[:5]] + [''] * (5 - len(row[:5]))
+        timestamp, action, number = row[0], row[3], row[4].strip()
+        if not LOG_TIMESTAMP.match(timestamp) or timestamp >= cutoff:
+            kept.append(row)
+            continue
+        old_rows.append(position)
+        rollup = SEARCH_ROLLUP.match(action)
+        if rollup or action.startswith(SEARCH_ACTION):
+            count, last = searches.get(number, (0, ''))
+            searches[number] = (count + (int(rollup.group(1)) if rollup else 1), max(last, timestamp))
+        if not rollup:
+            # Прошлые счётчики в архив не идут: их поиски уже там
+            archive.setdefault(timestamp[:7], []).append(row)
+    rollups = [
+        [last, '', '📦 архив', f"{SEARCH_ACTION} ×{count}", number]
+        for number, (count, last) in sorted(searches.items(), key=lambda item: item[1][1])
+    ]
+    return old_rows, rollups, archive, kept
+
+
+class LogCompactor(BackgroundFlusher):
+    """Раз в interval секунд уносит из листа Logs записи старше max_age_days.
+
+    Старые записи уходят в архив по месяцам — листы «Logs 2026-01» или
+    файлы LOG_ARCHIVE_DIR/logs-2026-01.csv.gz, — а старые поиски
+    сворачиваются в одну строку-счётчик на номер. Лист остаётся маленьким,
+    поэтому его полное чтение («Показать ещё», прогрев) не растёт вместе
+    с историей. Лист переписывается одним batch_update уже после записи
+    архива: при сбое между ними строки в архиве могут задвоиться, но не
+    пропадут. В режиме sqlite полная история остаётся в базе.
+    """
+
+    def __init__(self, connection, index, writer, max_age_days, interval, archive, archive_dir):
+        super().__init__(interval)
+        self.connection = connection
+        self.index = index
+        self.writer = writer
+        self.max_age_days = max_age_days
+        self.archive = archive
+        self.archive_dir = archive_dir
+
+    async def _archive_sheet(self, conn, month, rows):
+        title = f"Logs {month}"
+        try:
+            worksheet = await sheets_io.call(conn.spreadsheet.worksheet, title)
+        except gspread.exceptions.WorksheetNotFound:
+            worksheet = await sheets_io.call(
+                conn.spreadsheet.add_worksheet, title, rows=1, cols=5, idempotent=False
+            )
+            rows = [['Время', 'ID', 'Пользователь', 'Действие', 'Номер']] + rows
+        await sheets_io.call(worksheet.append_rows, rows, value_input_option='RAW', idempotent=False)
+
+    def _archive_file(self, month, rows):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"logs-{month}.csv.gz")
+        # Режим "at" дописывает ещё один gzip-поток — gzip/zcat читают файл целиком
+        with gzip.open(path, "at", encoding="utf-8", newline="") as f:
+            csv.writer(f).writerows(rows)
+
+    @staticmethod
+    def _requests(sheet_id, old_rows, rollups):
+        """Удаление старых строк (снизу вверх) и вставка счётчиков под заголовок"""
+        ranges = []
+        for position in old_rows:
+            if ranges and ranges[-1][1] == position - 1:
+                ranges[-1][1] = position
+            else:
+                ranges.append([position, position])
+        requests = [
+            {"deleteDimension": {"range": {
+                "sheetId": sheet_id, "dimension": "ROWS", "startIndex": first - 1, "endIndex": last,
+            }}}
+            for first, last in reversed(ranges)
+        ]
+        if rollups:
+            requests.append({"insertDimension": {"range": {
+                "sheetId": sheet_id, "dimension": "ROWS", "startIndex": 1, "endIndex": 1 + len(rollups),
+            }, "inheritFromBefore": False}})
+            requests.append({"updateCells": {
+                "range": {
+                    "sheetId": sheet_id,
+                    "startRowIndex": 1, "endRowIndex": 1 + len(rollups),
+                    "startColumnIndex": 0, "endColumnIndex": 5,
+                },
+                "rows": [{"values": [{"userEnteredValue": {"stringValue": v}} for v in row]} for row in rollups],
+                "fields": "userEnteredValue",
+            }})
+        return requests
+
+    async def compact(self):
+        """Один проход сжатия; (строк в архив, строк осталось в листе)"""
+        await self.writer.flush()
+        cutoff = datetime.fromtimestamp(time.time() - self.max_age_days * 86400).strftime("%Y-%m-%d %H:%M:%S")
+        # Блокировка журнала: пока лист переписывается, в него не дописывают и его не дочитывают
+        async with self.index.lock:
+            conn = await self.connection.get()
+            all_logs = await sheets_io.call(conn.logs_sheet.get_all_values)
+            old_rows, rollups, archive, kept = compact_log_rows(all_logs, cutoff)
+            if not archive:
+                return 0, len(all_logs)
+            for month, rows in sorted(archive.items()):
+                if self.archive == "gzip":
+                    await asyncio.to_thread(self._archive_file, month, rows)
+                else:
+                    await self._archive_sheet(conn, month, rows)
+            await sheets_io.call(
+                conn.spreadsheet.batch_update, {"requests": self._requests(conn.logs_sheet.id, old_rows, rollups)},
+                idempotent=False,
+            )
+            new_logs = all_logs[:1] + rollups + kept
+            if storage.name == "sheets":
+                # Индекс строится по листу заново; ещё не записанные строки — поверх
+                self.index.load(new_logs)
+                for row in self.writer._read_spill() + self.writer.buffer:
+                    self.index.add(row)
+            else:
+                self.index.reset_tail(len(new_logs))
+        log_history_cache.items.clear()
+        archived = sum(len(rows) for rows in archive.values())
+        metrics.inc("bot_log_compactions_total")
+        metrics.inc("bot_log_archived_rows_total", archived)
+        logger.info(
+            f"🗜️ Журнал сжат: {archived} записей старше {cutoff[:10]} в архив, "
+            f"{len(rollups)} счётчиков поиска, в листе {len(new_logs)} строк"
+        )
+        return archived, len(new_logs)
+
+    async def flush(self):
+        if not self.index.ready:
+            return
+        try:
+            await self.compact()
+        except Exception as e:
+            if not isinstance(e, SheetsUnavailable):
+                logger.error(f"Ошибка сжатия журнала: {e}")
+
+    async def stop(self):
+        # Сжатие не срочное — при остановке его не ждём
+        await self._cancel()
+
+
+log_compactor = LogCompactor(
+    google, log_index, log_writer, LOG_ARCHIVE_DAYS, LOG_COMPACT_INTERVAL, LOG_ARCHIVE, LOG_ARCHIVE_DIR
+)
+
+def inventory_add(number, shelf, add_date):
+    """Добавляет пружину в индекс, хранилище и очередь записи в таблицу"""
+    return inventory_add_many([(number, shelf, add_date)])[0]
+
+def inventory_add_many(items):
+    """Добавляет пачку (номер, полка, дата) — в таблицу уходит одним append"""
+    records = [spring_index.add(number, shelf, add_date) for number, shelf, add_date in items]
+    storage.add(records)
+    if records:
+        sheet_writer.add([[r['number'], r['shelf'], r['add_date']] for r in records], records[0]['row_index'])
+    return records
+
+def inventory_move(record, shelf):
+    """Переносит запись на другую полку"""
+    sheet_writer.move(record['row_index'], shelf)
+    spring_index.set_shelf(record, shelf)
+    storage.move(record)
+
+def inventory_delete(records):
+    """Удаляет записи одной пачкой; строки ниже сдвигаются вверх"""
+    # Снизу вверх: каждое удаление в таблице не сдвигает ещё не удалённые строки
+    for record in sorted(records, key=lambda r: r['row_index'], reverse=True):
+        sheet_writer.delete(record['row_index'])
+    spring_index.delete(records)
+    storage.delete(records)
+
+def replay_sheet_journal():
+    """Возвращает в очередь записи операции из журнала после перезапуска.
+
+    В режиме sheets индекс только что прочитан из таблицы, где этих
+    операций ещё нет, поэтому они применяются и к индексу — в том же
+    порядке, в котором бот их выполнял. SQLite их уже содержит.
+    """
+    ops = sheet_writer.read_journal()
+    if not ops:
+        return
+    if storage.name == "sheets":
+        for op in ops:
+            if op[0] == 'add':
+                for number, shelf, add_date in op[1]:
+                    spring_index.add(number, shelf, add_date)
+                continue
+            if not 2 <= op[1] < len(spring_index.rows) + 2:
+                logger.warning(f"⚠️ Операция из журнала вне таблицы: {op}")
+                continue
+            record = spring_index.rows[op[1] - 2]
+            if op[0] == 'move':
+                spring_index.set_shelf(record, op[2])
+            else:
+                spring_index.delete([record])
+    sheet_writer.pending = ops + sheet_writer.pending
+    sheet_writer.journaled = True
+    logger.warning(f"📒 Из журнала {sheet_writer.journal_path} в очередь записи возвращено {len(ops)} операций")
+
+resync_task = None
+
+def schedule_resync():
+    """Запускает сверку склада с таблицей, если она ещё не идёт"""
+    global resync_task
+    if resync_task is None or resync_task.done():
+        # Только чтение — сразу, а не когда задача начнёт работать
+        spring_index.resyncing = True
+        resync_task = asyncio.create_task(resync_inventory())
+
+async def rewrite_sheet_mirror():
+    """Режим sqlite: переписывает лист склада целиком из базы (через индекс)"""
+    conn = await google.get()
+    values = [['Номер', 'Полка', 'Дата добавления']] + [
+        [r['number'], r['shelf'], r['add_date']] for r in spring_index.rows
+    ]
+    await sheets_io.call(conn.sheet.clear)
+    await sheets_io.call(conn.sheet.update, 'A1', values, value_input_option='RAW')
+
+async def resync_inventory():
+    """Сверяет склад с таблицей, когда номера строк разошлись.
+
+    Пока идёт сверка, склад только для чтения. Сначала дописываются
+    оставшиеся добавления, затем в режиме sheets индекс перечитывается из
+    таблицы, а в режиме sqlite лист, наоборот, переписывается из базы.
+    """
+    spring_index.resyncing = True
+    metrics.inc("bot_sheet_resyncs_total")
+    delay = 1
+    try:
+        while True:
+            try:
+                await sheet_writer.flush()
+                if sheet_writer.pending:
+                    raise RuntimeError(f"в очереди записи ещё {len(sheet_writer.pending)} операций")
+                if storage.name == "sheets":
+                    all_values, _ = await storage.load_inventory()
+                    spring_index.load(all_values)
+                else:
+                    await rewrite_sheet_mirror()
+                sheet_writer.out_of_sync = False
+                logger.info("🔁 Склад сверен с таблицей")
+                return
+            except Exception as e:
+                logger.error(f"Сверка склада с таблицей не удалась, повтор через {delay} с: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, WARMUP_MAX_DELAY)
+    finally:
+        spring_index.resyncing = False
+
 def find_all_springs_by_number(number):
-    """Находит все пружины по номеру"""
-    matches = []
-    all_values = sheet.get_all_values()
-    for i, row in enumerate(all_values[1:], 1):
-        if row and len(row) > 0 and str(row[0]).strip() == number.strip():
-            matches.append({
-                'row_index': i + 1,
-                'shelf': row[1] if len(row) > 1 else '❓',
-                'add_date': format_date(row[2] if len(row) > 2 else ''),
-                'number': number
-            })
-    return matches
+    """Находит все пружины по номеру (по индексу, без запроса к таблице)"""
+    return [
+        {
+            'id': record['id'],
+            'row_index': record['row_index'],
+            'shelf': record['shelf'] or '❓',
+            'add_date': format_date(record['add_date']),
+            'number': number
+        }
+        for record in spring_index.find(number)
+    ]
+
+# Защита квоты Sheets от всплесков
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_PER_SEC = float(os.getenv("RATE_LIMIT_PER_SEC", "2"))
+LOG_HISTORY_TTL = int(os.getenv("LOG_HISTORY_TTL", "30"))
+
+class RateLimiter:
+    """Token bucket на пользователя: burst запросов сразу, дальше rate в секунду"""
+
+    def __init__(self, burst, rate):
+        self.burst = burst
+        self.rate = rate
+        self.buckets = {}  # user_id → (токены, время последнего запроса)
+
+    def allow(self, user_id):
+        now = time.monotonic()
+        tokens, last = self.buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        if not allowed:
+            metrics.inc("bot_throttled_total")
+        return allowed
+
+
+class SingleFlight:
+    """Одинаковые одновременные запросы ждут один общий вызов"""
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def do(self, key, factory):
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+            metrics.inc("bot_singleflight_total", result="call")
+        else:
+            metrics.inc("bot_singleflight_total", result="shared")
+        # shield: если один из ждущих отменён, остальные всё равно получат результат
+        return await asyncio.shield(future)
+
+
+class TTLCache:
+    """Результаты, которые живут ttl секунд"""
+
+    def __init__(self, ttl, max_size=1000, name="cache"):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.name = name
+        self.items = {}  # ключ → (срок, значение)
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is not None and item[0] < time.monotonic():
+            del self.items[key]
+            item = None
+        metrics.inc("bot_cache_requests_total", cache=self.name, result="miss" if item is None else "hit")
+        return None if item is None else item[1]
+
+    def set(self, key, value):
+        if len(self.items) >= self.max_size:
+            now = time.monotonic()
+            self.items = {k: v for k, v in self.items.items() if v[0] >= now}
+            if len(self.items) >= self.max_size:
+                self.items.pop(next(iter(self.items)))
+        self.items[key] = (time.monotonic() + self.ttl, value)
+
+    def invalidate(self, key):
+        self.items.pop(key, None)
+
 
-def find_logs_by_number(number):
-    """Находит все логи по номеру пружины"""
+class UserLocks:
+    """По замку на пользователя: его апдейты обрабатываются по одному.
+
+    PTB с concurrent_updates запускает все апдейты параллельно, в том числе
+    два нажатия одного человека — без замка второе могло бы изменить склад
+    раньше первого. asyncio.Lock пускает ждущих в порядке прихода; замок
+    удаляется, когда его больше никто не держит и не ждёт.
+    """
+
+    def __init__(self):
+        self.locks = {}  # user_id → (замок, сколько держат или ждут)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, user_id):
+        lock, users = self.locks.get(user_id, (None, 0))
+        lock = lock or asyncio.Lock()
+        self.locks[user_id] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self.locks[user_id]
+            if users == 1:
+                del self.locks[user_id]
+            else:
+                self.locks[user_id] = (lock, users - 1)
+
+
+def serialized(handler):
+    """Апдейты одного пользователя — по очереди, в порядке прихода"""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        async with user_locks.hold(update.effective_user.id):
+            return await handler(update, context)
+    return wrapper
+
+
+rate_limiter = RateLimiter(RATE_LIMIT_BURST, RATE_LIMIT_PER_SEC)
+user_locks = UserLocks()
+sheet_reads = SingleFlight()
+log_history_cache = TTLCache(LOG_HISTORY_TTL, name="log_history")
+callbacks_in_flight = set()  # (user_id, callback_data) — защита от двойного нажатия
+
+async def read_all_logs():
+    conn = await google.get()
+    return await sheets_io.call(conn.logs_sheet.get_all_values)
+
+async def find_logs_by_number(number):
+    """Находит все логи по номеру пружины (для «Показать ещё»: из SQLite или полным чтением листа).
+
+    Полное чтение листа общее для всех одновременных запросов, а результат
+    по номеру кэшируется на LOG_HISTORY_TTL секунд.
+    """
+    logs = storage.logs_for(number)
+    if logs is not None:
+        return logs
+    logs = log_history_cache.get(number.strip())
+    if logs is not None:
+        return logs
     logs = []
-    all_logs = logs_sheet.get_all_values()
+    all_logs = await sheet_reads.do("logs", read_all_logs)
     for i, row in enumerate(all_logs[1:], 1):
         if row and len(row) >= 5 and str(row[4]).strip() == number.strip():
             logs.append({
@@ -94,132 +1599,370 @@ def find_logs_by_number(number):
                 'action': row[3],
                 'number': row[4]
             })
-    return sorted(logs, key=lambda x: x['timestamp'], reverse=True)
-
-def find_last_added_row():
-    """Возвращает номер последней строки с пружиной"""
-    all_values = sheet.get_all_values()
-    for i in range(len(all_values)-1, 0, -1):
-        if all_values[i] and len(all_values[i]) > 0 and all_values[i][0]:
-            return i + 1
-    return 1
-
-def shelves_keyboard(number, mode="add"):
-    """Клавиатура полок с режимом"""
-    prefix = f"{mode}_confirm:{number}:"
+    logs.sort(key=lambda x: x['timestamp'], reverse=True)
+    log_history_cache.set(number.strip(), logs)
+    return logs
+
+# Состояние кнопок: в callback_data только «действие:токен», данные — на сервере
+CALLBACK_TTL = int(os.getenv("CALLBACK_TTL_HOURS", "48")) * 3600
+CALLBACK_MAX_STATES = int(os.getenv("CALLBACK_MAX_STATES", "100000"))
+
+class CallbackStates:
+    """Таблица состояний кнопок с вытеснением по сроку жизни.
+
+    Telegram ограничивает callback_data 64 байтами, а номер пружины или
+    название полки могут быть длинными, поэтому в кнопку кладётся короткий
+    случайный токен. Одинаковые данные получают один и тот же токен, так
+    что перерисовка клавиатур не раздувает таблицу.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.states = OrderedDict()  # токен → (срок, действие, данные)
+        self.tokens = {}             # (действие, данные) → токен
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.states:
+            token, (expires, action, payload) = next(iter(self.states.items()))
+            if expires >= now and len(self.states) <= self.max_size:
+                break
+            del self.states[token]
+            self.tokens.pop((action, tuple(sorted(payload.items()))), None)
+
+    def data(self, action, **payload):
+        """callback_data для кнопки: «действие» или «действие:токен»"""
+        if not payload:
+            return action
+        key = (action, tuple(sorted(payload.items())))
+        token = self.tokens.get(key)
+        if token is None:
+            token = secrets.token_urlsafe(6)
+            self.tokens[key] = token
+        else:
+            self.states.move_to_end(token)
+        self.states[token] = (time.monotonic() + self.ttl, action, payload)
+        self._evict()
+        return f"{action}:{token}"
+
+    def resolve(self, data):
+        """(действие, данные); данные None, если кнопка устарела"""
+        action, _, token = data.partition(":")
+        if not token:
+            return action, {}
+        state = self.states.get(token)
+        if state is None or state[1] != action or state[0] < time.monotonic():
+            metrics.inc("bot_cache_requests_total", cache="callback_state", result="miss")
+            return action, None
+        metrics.inc("bot_cache_requests_total", cache="callback_state", result="hit")
+        return action, state[2]
+
+
+callback_states = CallbackStates(CALLBACK_TTL, CALLBACK_MAX_STATES)
+cb = callback_states.data
+
+def logs_response(number, logs, total, page=0):
+    """Страница истории: текст и клавиатура с «Показать ещё»"""
+    start = page * LOGS_PAGE_SIZE
+    response = f"📋 <b>История <code>{number}</code> ({total} действий):</b>\n\n"
+    for i, log in enumerate(logs[start:start + LOGS_PAGE_SIZE], start + 1):
+        timestamp = log['timestamp'][:16]
+        response += f"{i}. {timestamp} | <code>{log['username']}</code>\n"
+        response += f"   {log['action']}\n\n"
+    # Строка-счётчик «🔍 искал ×N» — это N действий
+    rest = total - sum(log_weight(log['action']) for log in logs[:start + LOGS_PAGE_SIZE])
+    buttons = []
+    if rest > 0:
+        response += f"... и ещё {rest} действий"
+        buttons.append([InlineKeyboardButton("⬇️ Показать ещё", callback_data=cb("logs_more", number=number, page=page + 1))])
+    buttons.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
+    return response, InlineKeyboardMarkup(buttons)
+
+# Массовый ввод и выгрузка
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "5000"))
+# Длиннее — почти наверняка не пружина, а мусор из файла (и таблица может отвергнуть ячейку)
+MAX_NUMBER_LEN = 64
+MAX_SHELF_LEN = 32
+MAX_DATE_LEN = 32
+
+def split_bulk_text(text):
+    """Разбивает вставленный список или CSV на поля; разделитель — , ; или Tab"""
+    first_line = next((line for line in text.splitlines() if line.strip()), "")
+    delimiter = ","
+    for candidate in ("\t", ";"):
+        if candidate in first_line and "," not in first_line:
+            delimiter = candidate
+    return list(csv.reader(io.StringIO(text), delimiter=delimiter))
+
+def parse_bulk_rows(rows):
+    """Проверяет строки «номер, полка[, дата]» локально: (пружины, ошибки)"""
+    items, errors = [], []
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    first = True
+    for line_no, fields in enumerate(rows, 1):
+        fields = [f.strip() for f in fields]
+        if not any(fields):
+            continue
+        # Заголовок — первая непустая строка, даже если перед ней пустые
+        if first and fields[0].lower() in ("номер", "number"):
+            first = False
+            continue
+        first = False
+        line = ', '.join(fields)
+        if len(line) > 60:
+            line = line[:60] + "…"
+        if len(fields) < 2 or not fields[0] or not fields[1]:
+            errors.append(f"{line_no}: {line}")
+            continue
+        add_date = fields[2] if len(fields) > 2 and fields[2] else now
+        if len(fields[0]) > MAX_NUMBER_LEN or len(fields[1]) > MAX_SHELF_LEN or len(add_date) > MAX_DATE_LEN:
+            errors.append(f"{line_no}: слишком длинно — {line}")
+            continue
+        items.append((fields[0], fields[1].upper(), add_date))
+    return items, errors
+
+async def bulk_add(update, context, rows):
+    """Добавляет всё одной пачкой и отвечает одной сводкой"""
+    user = update.effective_user
+    if len(rows) > BULK_MAX_ROWS:
+        await update.message.reply_text(f"⚠️ Слишком много строк: {len(rows)} (максимум {BULK_MAX_ROWS}).")
+        return
+    items, errors = parse_bulk_rows(rows)
+    records = inventory_add_many(items)
+    log_rows([
+        log_row(user.id, user.username, "➕ добавление", f"Полка: {record['shelf']} (пакет)", record['number'])
+        for record in records
+    ])
+    response = f"📦 <b>Добавлено {len(records)} пружин</b>"
+    if records:
+        response += f" (стр. {records[0]['row_index']}–{records[-1]['row_index']})"
+    if errors:
+        response += f"\n\n⚠️ <b>Пропущено строк: {len(errors)}</b>\n"
+        response += "\n".join(f"<code>{e}</code>" for e in errors[:10])
+        if len(errors) > 10:
+            response += f"\n... и ещё {len(errors) - 10}"
+    context.user_data.clear()
+    await update.message.reply_text(response, reply_markup=main_menu_keyboard(), parse_mode='HTML')
+
+def export_csv():
+    """Весь склад из индекса в CSV (UTF-8 с BOM, чтобы Excel открыл кириллицу)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['Номер', 'Полка', 'Дата добавления'])
+    for record in spring_index.rows:
+        if record['number']:
+            writer.writerow([record['number'], record['shelf'], record['add_date']])
+    return buffer.getvalue().encode("utf-8-sig")
+
+# Раскладка полок склада — по ней строятся клавиатуры выбора и сводка
+SHELF_LAYOUT = [
+    ["A1", "B1", "C1"],
+    ["A2", "B2", "C2"],
+    ["A3", "B3", "C3"],
+    ["A4", "B4"],
+    ["A5", "B5"],
+    ["A6", "B6"],
+    ["A7", "B7"],
+]
+SHELF_PAGE_SIZE = 20
+
+def shelves_keyboard(action, **payload):
+    """Клавиатура полок: каждая кнопка — action с полкой и payload"""
     keyboard = [
-        [InlineKeyboardButton("A1", callback_data=f"{prefix}a1"), 
-         InlineKeyboardButton("B1", callback_data=f"{prefix}b1"), 
-         InlineKeyboardButton("C1", callback_data=f"{prefix}c1")],
-        [InlineKeyboardButton("A2", callback_data=f"{prefix}a2"), 
-         InlineKeyboardButton("B2", callback_data=f"{prefix}b2"), 
-         InlineKeyboardButton("C2", callback_data=f"{prefix}c2")],
-        [InlineKeyboardButton("A3", callback_data=f"{prefix}a3"), 
-         InlineKeyboardButton("B3", callback_data=f"{prefix}b3"), 
-         InlineKeyboardButton("C3", callback_data=f"{prefix}c3")],
-        [InlineKeyboardButton("A4", callback_data=f"{prefix}a4"), 
-         InlineKeyboardButton("B4", callback_data=f"{prefix}b4")],
-        [InlineKeyboardButton("A5", callback_data=f"{prefix}a5"), 
-         InlineKeyboardButton("B5", callback_data=f"{prefix}b5")],
-        [InlineKeyboardButton("A6", callback_data=f"{prefix}a6"), 
-         InlineKeyboardButton("B6", callback_data=f"{prefix}b6")],
-        [InlineKeyboardButton("A7", callback_data=f"{prefix}a7"), 
-         InlineKeyboardButton("B7", callback_data=f"{prefix}b7")],
-        [InlineKeyboardButton("❌ Отмена", callback_data="main_menu")]
+        [InlineKeyboardButton(shelf, callback_data=cb(action, shelf=shelf, **payload)) for shelf in row]
+        for row in SHELF_LAYOUT
     ]
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="main_menu")])
     return InlineKeyboardMarkup(keyboard)
 
+def shelf_summary_view():
+    """Сводка по полкам: сколько пружин на каждой"""
+    counts = spring_index.shelf_counts()
+    layout = [shelf for row in SHELF_LAYOUT for shelf in row]
+    others = sorted(shelf for shelf in counts if shelf not in layout)
+    response = f"🗄️ <b>Полки</b> (всего {sum(counts.values())} пружин)\n\n"
+    occupied = [shelf for shelf in layout + others if counts.get(shelf)]
+    response += "\n".join(f"<b>{shelf or '❓'}</b>: {counts[shelf]}" for shelf in occupied) or "Все полки пусты."
+    buttons = [
+        [InlineKeyboardButton(f"{shelf} ({counts.get(shelf, 0)})", callback_data=cb("shelf", shelf=shelf, page=0)) for shelf in row]
+        for row in SHELF_LAYOUT
+    ]
+    for i in range(0, len(others), 3):
+        buttons.append([
+            InlineKeyboardButton(f"{shelf or '❓'} ({counts[shelf]})", callback_data=cb("shelf", shelf=shelf, page=0))
+            for shelf in others[i:i + 3]
+        ])
+    buttons.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
+    return response, InlineKeyboardMarkup(buttons)
+
+def shelf_page_view(shelf, page=0):
+    """Что лежит на полке — по SHELF_PAGE_SIZE пружин на страницу"""
+    records = spring_index.on_shelf(shelf)
+    pages = max((len(records) + SHELF_PAGE_SIZE - 1) // SHELF_PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+    start = page * SHELF_PAGE_SIZE
+    response = f"🗄️ <b>Полка {shelf_key(shelf) or '❓'}</b>: {len(records)} пружин"
+    if pages > 1:
+        response += f" (стр. {page + 1}/{pages})"
+    response += "\n\n"
+    if not records:
+        response += "Пусто."
+    for i, record in enumerate(records[start:start + SHELF_PAGE_SIZE], start + 1):
+        response += f"{i}. <code>{record['number']}</code> — стр.{record['row_index']}, {format_date(record['add_date'])}\n"
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️", callback_data=cb("shelf", shelf=shelf_key(shelf), page=page - 1)))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("➡️", callback_data=cb("shelf", shelf=shelf_key(shelf), page=page + 1)))
+    buttons = [navigation] if navigation else []
+    buttons.append([InlineKeyboardButton("🗄️ Все полки", callback_data="shelves")])
+    buttons.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
+    return response, InlineKeyboardMarkup(buttons)
+
 def main_menu_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("➕ Добавить пружину", callback_data="add_spring")],
-        [InlineKeyboardButton("📋 Логи", callback_data="logs_mode")]
+        [InlineKeyboardButton("📦 Массовый ввод", callback_data="bulk_mode"),
+         InlineKeyboardButton("📤 Выгрузка CSV", callback_data="export_csv")],
+        [InlineKeyboardButton("🗄️ Полки", callback_data="shelves"),
+         InlineKeyboardButton("📋 Логи", callback_data="logs_mode")]
     ])
 
 def action_keyboard(number):
     """Клавиатура действий при поиске"""
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🗑️ Удалить", callback_data=f"delete_select:{number}")],
-        [InlineKeyboardButton("🔄 Переместить", callback_data=f"move_select:{number}")],
+        [InlineKeyboardButton("🗑️ Удалить", callback_data=cb("delete_select", number=number))],
+        [InlineKeyboardButton("🔄 Переместить", callback_data=cb("move_select", number=number))],
         [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
     ])
 
+def suggestions_keyboard(numbers):
+    """Кнопки «возможно, ты искал» — открывают карточку номера"""
+    buttons = [[InlineKeyboardButton(f"🔍 {number} ({len(spring_index.find(number))} шт)",
+                                     callback_data=cb("action_menu", number=number))]
+               for number in numbers]
+    buttons.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
+    return InlineKeyboardMarkup(buttons)
+
 def delete_keyboard(matches, number):
     """Клавиатура выбора удаления"""
     buttons = [[InlineKeyboardButton(f"🗑️ стр.{m['row_index']} {m['shelf']}", 
-                                    callback_data=f"del_select:{m['row_index']}:{number}:{m['shelf']}")] 
+                                    callback_data=cb("del_select", record_id=m['id']))] 
                for m in matches[:8]]
-    buttons.append([InlineKeyboardButton("🔙 Назад к поиску", callback_data=f"action_menu:{number}")])
+    buttons.append([InlineKeyboardButton("🔙 Назад к поиску", callback_data=cb("action_menu", number=number))])
     buttons.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
     return InlineKeyboardMarkup(buttons)
 
 def move_keyboard(matches, number):
     """Клавиатура выбора перемещения"""
     buttons = [[InlineKeyboardButton(f"🔄 стр.{m['row_index']} {m['shelf']} →", 
-                                    callback_data=f"move_row:{m['row_index']}:{number}:{m['shelf']}")] 
+                                    callback_data=cb("move_row", record_id=m['id']))] 
                for m in matches[:8]]
-    buttons.append([InlineKeyboardButton("🔙 Назад к поиску", callback_data=f"action_menu:{number}")])
+    buttons.append([InlineKeyboardButton("🔙 Назад к поиску", callback_data=cb("action_menu", number=number))])
     buttons.append([InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")])
     return InlineKeyboardMarkup(buttons)
 
-def saved_keyboard(number):
+def saved_keyboard(record):
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🗑️ Удалить эту", callback_data=f"delete_last:{number}")],
+        [InlineKeyboardButton("🗑️ Удалить эту", callback_data=cb("delete_last", record_id=record['id']))],
         [InlineKeyboardButton("✅ Готово", callback_data="exit_add_mode")]
     ])
 
-async def log_action(context, user_id, username, action, details, spring_number):
-    """Правильное логирование"""
+WARMING_UP_TEXT = "⏳ Склад ещё загружается из таблицы, попробуй через минуту."
+READ_ONLY_TEXT = "🛟 Склад сейчас открыт только для поиска: Google-таблица недоступна или сверяется. Изменения — чуть позже."
+
+def log_row(user_id, username, action, details, spring_number):
+    """Строка журнала: время, ID, пользователь, действие, номер"""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    username = username or "пользователь"
-    log_entry = f"{action}: {details}"
-    row = [timestamp, user_id, username, log_entry, spring_number]
-    try:
-        logs_sheet.append_row(row)
-    except Exception as e:
-        logger.error(f"Ошибка лога: {e}")
+    return [timestamp, user_id, username or "пользователь", f"{action}: {details}", spring_number]
 
+def log_rows(rows):
+    """Пачка строк журнала — одной записью в хранилище, в таблицу через log_writer"""
+    storage.log_many(rows)
+    for row in rows:
+        log_writer.add(row)
+        log_history_cache.invalidate(str(row[4]).strip())
+
+async def log_action(context, user_id, username, action, details, spring_number):
+    """Правильное логирование (запись в таблицу — пакетами, в фоне)"""
+    log_rows([log_row(user_id, username, action, details, spring_number)])
+
+THROTTLED_TEXT = "⏳ Слишком много запросов, подожди пару секунд."
+
+def parse_pair(content):
+    """«123, A1» → ('123', 'A1'); None, если частей не две или одна пустая"""
+    parts = [x.strip() for x in content.split(",")]
+    if len(parts) != 2 or not all(parts):
+        return None
+    return parts[0], parts[1]
+
+@serialized
+@timed("text")
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     user = update.effective_user
+
+    if not rate_limiter.allow(user.id):
+        await update.message.reply_text(THROTTLED_TEXT)
+        return
     
     if context.user_data.get("add_mode"):
         context.user_data["current_number"] = text
         await update.message.reply_text(
             f"✅ <b>Номер:</b> <code>{text}</code>\n\n"
             "📍 <b>Выбери полку:</b>",
-            reply_markup=shelves_keyboard(text, "add"),
+            reply_markup=shelves_keyboard("add_confirm", number=text),
             parse_mode='HTML'
         )
         return
     
+    if context.user_data.get("bulk_mode"):
+        if not spring_index.ready:
+            await update.message.reply_text(WARMING_UP_TEXT)
+            return
+        if spring_index.read_only:
+            await update.message.reply_text(READ_ONLY_TEXT)
+            return
+        await bulk_add(update, context, split_bulk_text(text))
+        return
+
     if context.user_data.get("logs_mode"):
-        logs = find_logs_by_number(text)
+        if not log_index.ready:
+            await update.message.reply_text(WARMING_UP_TEXT)
+            return
+        logs, total = log_index.history(text)
         if logs:
-            response = f"📋 <b>История <code>{text}</code> ({len(logs)} действий):</b>\n\n"
-            for i, log in enumerate(logs[:5], 1):  # Показываем только 5 последних
-                timestamp = log['timestamp'][:16]
-                response += f"{i}. {timestamp} | <code>{log['username']}</code>\n"
-                response += f"   {log['action']}\n\n"
-            if len(logs) > 5:
-                response += f"... и ещё {len(logs)-5} действий"
+            response, keyboard = logs_response(text, logs, total)
         else:
             response = f"⚠️ Логов для <code>{text}</code> не найдено."
-        
-        keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
-        ])
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
+            ])
         await update.message.reply_text(response, reply_markup=keyboard, parse_mode='HTML')
         context.user_data.clear()
         return
 
+    if not spring_index.ready:
+        await update.message.reply_text(WARMING_UP_TEXT, reply_markup=main_menu_keyboard())
+        return
+
+    if text[:1] in ("+", "-", "=") and spring_index.read_only:
+        await update.message.reply_text(READ_ONLY_TEXT, reply_markup=main_menu_keyboard())
+        return
+
     try:
         if text.startswith("+"):
-            content = text[1:].strip()
-            number, shelf = [x.strip() for x in content.split(",")]
-            sheet.append_row([number, shelf, datetime.now().strftime("%Y-%m-%d %H:%M")])
+            pair = parse_pair(text[1:])
+            if pair is None:
+                await update.message.reply_text("❌ Проверь формат: <code>+123, A1</code>", parse_mode='HTML')
+                return
+            number, shelf = pair
+            add_date = datetime.now().strftime("%Y-%m-%d %H:%M")
+            row_index = inventory_add(number, shelf, add_date)['row_index']
             await log_action(context, user.id, user.username, "➕ добавление", f"Полка: {shelf}", number)
             await update.message.reply_text(
-                f"🎉 <b>{number}</b> добавлена на <b>{shelf}</b>!",
+                f"🎉 <b>{number}</b> добавлена на <b>{shelf}</b> (стр. {row_index})!",
                 reply_markup=main_menu_keyboard(),
                 parse_mode='HTML'
             )
@@ -227,10 +1970,9 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
 
         elif text.startswith("-"):
             number = text[1:].strip()
-            matches = find_all_springs_by_number(number)
+            matches = spring_index.find(number)
             if matches:
-                for match in matches:
-                    sheet.delete_rows(match['row_index'])
+                inventory_delete(matches)
                 await log_action(context, user.id, user.username, "🗑️ удаление", f"{len(matches)} шт", number)
                 await update.message.reply_text(
                     f"🗑️ <b>Удалено {len(matches)} пружин</b> <code>{number}</code>",
@@ -242,12 +1984,15 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             return
 
         elif text.startswith("="):
-            content = text[1:].strip()
-            number, new_shelf = [x.strip() for x in content.split(",")]
-            matches = find_all_springs_by_number(number)
+            pair = parse_pair(text[1:])
+            if pair is None:
+                await update.message.reply_text("❌ Проверь формат: <code>=123, B2</code>", parse_mode='HTML')
+                return
+            number, new_shelf = pair
+            matches = spring_index.find(number)
             if matches:
-                for match in matches:
-                    sheet.update_cell(match['row_index'], 2, new_shelf)
+                for record in matches:
+                    inventory_move(record, new_shelf)
                 await log_action(context, user.id, user.username, "🔄 перемещение", f"Полка: {new_shelf}", number)
                 await update.message.reply_text(
                     f"🔄 <b>{len(matches)} пружин</b> <code>{number}</code> → <b>{new_shelf}</b>",
@@ -283,15 +2028,65 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                             f"   📅 {match['add_date']}\n\n"
                         )
                     keyboard = action_keyboard(text)
+                if spring_index.snapshot_time:
+                    response += f"\n\n🛟 <i>Данные на {spring_index.snapshot_time}, таблица недоступна</i>"
                 
                 await update.message.reply_text(response, reply_markup=keyboard, parse_mode='HTML')
             else:
-                await update.message.reply_text("⚠️ Пружина не найдена.", reply_markup=main_menu_keyboard())
+                suggestions = spring_index.suggest(text)
+                if suggestions:
+                    await update.message.reply_text(
+                        f"⚠️ Пружина <code>{text}</code> не найдена.\n\n🤔 <b>Возможно, ты искал:</b>",
+                        reply_markup=suggestions_keyboard(suggestions),
+                        parse_mode='HTML'
+                    )
+                else:
+                    await update.message.reply_text("⚠️ Пружина не найдена.", reply_markup=main_menu_keyboard())
+
+    except Exception:
+        # Формат проверен выше — сюда попадают только сбои самого бота
+        logger.exception(f"Ошибка обработки «{text}»")
+        await update.message.reply_text("❌ Не получилось, попробуй ещё раз.", reply_markup=main_menu_keyboard())
 
+@serialized
+@timed("document")
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """CSV-файл в режиме массового ввода"""
+    if not rate_limiter.allow(update.effective_user.id):
+        await update.message.reply_text(THROTTLED_TEXT)
+        return
+    if not context.user_data.get("bulk_mode"):
+        await update.message.reply_text(
+            "📦 Чтобы загрузить CSV, открой «Массовый ввод».", reply_markup=main_menu_keyboard()
+        )
+        return
+    if not spring_index.ready:
+        await update.message.reply_text(WARMING_UP_TEXT)
+        return
+    if spring_index.read_only:
+        await update.message.reply_text(READ_ONLY_TEXT)
+        return
+    try:
+        file = await update.message.document.get_file()
+        raw = bytes(await file.download_as_bytearray())
     except Exception as e:
-        logger.error(f"Ошибка: {e}")
-        await update.message.reply_text("❌ Ошибка. Проверь формат: <code>+123, A1</code>", parse_mode='HTML')
+        logger.error(f"Ошибка загрузки файла: {e}")
+        await update.message.reply_text("❌ Не удалось скачать файл.")
+        return
+    try:
+        text = raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        try:
+            text = raw.decode("cp1251")
+        except UnicodeDecodeError:
+            # Байты вроде 0x98 есть в xlsx и любом двоичном файле, но не в тексте
+            await update.message.reply_text(
+                "⚠️ Это не CSV. Сохрани таблицу как «CSV (разделители — запятые)» и пришли ещё раз."
+            )
+            return
+    await bulk_add(update, context, split_bulk_text(text))
 
+@timed("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "🤖 <b>Склад пружин</b>\n\n"
@@ -299,179 +2094,472 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• <code>+123, A1</code> — добавить\n"
         "• <code>-123</code> — удалить все\n"
         "• <code>=123, B2</code> — переместить все\n"
-        "• <code>123</code> — найти\n\n"
+        "• <code>123</code> — найти\n"
+        "• <code>/shelf A1</code> — что на полке\n\n"
         "🎮 Используй кнопки ниже!",
         reply_markup=main_menu_keyboard(),
         parse_mode='HTML'
     )
 
+@timed("shelf")
+async def shelf_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/shelf — сводка по полкам, /shelf A1 — что лежит на полке"""
+    if not spring_index.ready:
+        await update.message.reply_text(WARMING_UP_TEXT)
+        return
+    if context.args:
+        response, keyboard = shelf_page_view(" ".join(context.args))
+    else:
+        response, keyboard = shelf_summary_view()
+    await update.message.reply_text(response, reply_markup=keyboard, parse_mode='HTML')
+
+# /stats — только для пользователей из ADMIN_IDS (через запятую)
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+
+def stats_view():
+    """Сводка метрик для /stats"""
+    uptime = time.time() - metrics.started
+    response = f"📊 <b>Статистика</b> (работает {int(uptime // 3600)} ч {int(uptime % 3600 // 60)} мин)\n\n"
+    response += f"📦 Пружин: {sum(1 for r in spring_index.rows if r['number'])}"
+    response += f", в очереди записи: {len(sheet_writer.pending)}, логов: {len(log_writer.buffer)}\n"
+    if sheets_io.breaker.is_open:
+        response += f"🛑 Google Sheets не отвечает, запросы приостановлены ({sheets_io.breaker.failures} ошибок подряд)\n"
+    if spring_index.snapshot_time:
+        response += f"🛟 Только поиск, снимок от {spring_index.snapshot_time}\n"
+    if spring_index.resyncing:
+        response += "🔁 Склад сверяется с таблицей, изменения приостановлены\n"
+    response += "\n"
+    response += "<b>Обработчики</b> (раз × среднее):\n"
+    for name, (count, avg) in sorted(metrics.timings("bot_handler_seconds", "handler").items()):
+        response += f"• {name}: {count} × {avg:.1f} мс\n"
+    response += "\n<b>Google Sheets:</b>\n"
+    for method, (count, avg) in sorted(metrics.timings("bot_sheets_call_seconds", "method").items()):
+        errors = metrics.count("bot_sheets_errors_total", method=method)
+        limited = metrics.count("bot_sheets_errors_total", method=method, status="429")
+        retries = metrics.count("bot_sheets_retries_total", method=method)
+        response += f"• {method}: {count} × {avg:.0f} мс, ошибок {errors} (429: {limited}), повторов {retries}\n"
+    response += "\n<b>Кэши:</b>\n"
+    for cache in ("log_history", "callback_state"):
+        hits = metrics.count("bot_cache_requests_total", cache=cache, result="hit")
+        total = hits + metrics.count("bot_cache_requests_total", cache=cache, result="miss")
+        rate = f"{hits * 100 // total}%" if total else "—"
+        response += f"• {cache}: {rate} попаданий из {total}\n"
+    response += f"\n⏳ Отказов по частоте: {metrics.count('bot_throttled_total')}"
+    return response
+
+@timed("stats")
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Команда только для администраторов.")
+        return
+    await update.message.reply_text(stats_view(), parse_mode='HTML')
+
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ограничение частоты и защита от двойного нажатия перед handle_callback"""
     query = update.callback_query
-    await query.answer()
-    data = query.data
     user = update.effective_user
+    if not rate_limiter.allow(user.id):
+        await query.answer(THROTTLED_TEXT)
+        return
+    key = (user.id, query.data)
+    if key in callbacks_in_flight:
+        # Та же кнопка ещё обрабатывается — второе нажатие ничего не делает
+        await query.answer()
+        return
+    callbacks_in_flight.add(key)
+    try:
+        # Разные кнопки одного пользователя — по очереди, чтобы склад менялся в порядке нажатий
+        async with user_locks.hold(user.id):
+            await handle_callback(update, context)
+    finally:
+        callbacks_in_flight.discard(key)
 
-    if data == "main_menu":
-        await query.edit_message_text("🤖 <b>Главное меню</b>", reply_markup=main_menu_keyboard(), parse_mode='HTML')
-        context.user_data.clear()
+CALLBACK_HANDLERS = {}  # действие → (обработчик, нужен ли загруженный индекс, меняет ли склад)
+
+def callback(action, needs_index=True, writes=False):
+    """Регистрирует обработчик кнопки: async def on_x(query, context, **данные)"""
+    def register(handler):
+        CALLBACK_HANDLERS[action] = (timed(f"callback:{action}")(handler), needs_index, writes)
+        return handler
+    return register
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    action, payload = callback_states.resolve(query.data)
+    handler, needs_index, writes = CALLBACK_HANDLERS.get(action, (None, False, False))
+    if handler is None or payload is None:
+        await query.edit_message_text("⚠️ Кнопка устарела, начни заново.", reply_markup=main_menu_keyboard())
+        return
+    if needs_index and not spring_index.ready:
+        await query.edit_message_text(WARMING_UP_TEXT, reply_markup=main_menu_keyboard())
         return
+    if writes and spring_index.read_only:
+        await query.edit_message_text(READ_ONLY_TEXT, reply_markup=main_menu_keyboard())
+        return
+    await handler(query, context, **payload)
 
-    if data == "exit_add_mode":
-        context.user_data.clear()
-        await query.edit_message_text("✅ Режим добавления завершён.", reply_markup=main_menu_keyboard())
+@callback("main_menu", needs_index=False)
+async def on_main_menu(query, context):
+    await query.edit_message_text("🤖 <b>Главное меню</b>", reply_markup=main_menu_keyboard(), parse_mode='HTML')
+    context.user_data.clear()
+
+@callback("exit_add_mode", needs_index=False)
+async def on_exit_add_mode(query, context):
+    context.user_data.clear()
+    await query.edit_message_text("✅ Режим добавления завершён.", reply_markup=main_menu_keyboard())
+
+@callback("logs_mode", needs_index=False)
+async def on_logs_mode(query, context):
+    context.user_data.clear()
+    context.user_data["logs_mode"] = True
+    await query.edit_message_text(
+        "📋 <b>Режим логов</b>\n\n"
+        "📝 Впиши номер пружины для просмотра истории:\n\n"
+        "Пример: <code>123</code>",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]),
+        parse_mode='HTML'
+    )
+
+@callback("bulk_mode", needs_index=False)
+async def on_bulk_mode(query, context):
+    context.user_data.clear()
+    context.user_data["bulk_mode"] = True
+    await query.edit_message_text(
+        "📦 <b>Массовый ввод</b>\n\n"
+        "📝 Вставь список строками <code>номер, полка</code>\n"
+        "или пришли CSV-файл с такими же колонками.\n\n"
+        "Пример:\n<code>123, A1\n456, B2</code>",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="main_menu")]]),
+        parse_mode='HTML'
+    )
+
+@callback("export_csv")
+async def on_export_csv(query, context):
+    await query.message.reply_document(
+        document=export_csv(),
+        filename=f"springs_{datetime.now().strftime('%Y-%m-%d')}.csv",
+        caption=f"📤 Склад: {sum(len(r) for r in spring_index.by_number.values())} пружин"
+    )
+
+@callback("add_spring", needs_index=False)
+async def on_add_spring(query, context):
+    context.user_data.clear()
+    context.user_data["add_mode"] = True
+    await query.edit_message_text(
+        "➕ <b>Режим массового добавления</b>\n\n"
+        "📝 Пиши номера пружин по очереди\n"
+        "❌ <code>выход</code> - завершить\n\n"
+        "Пример: <code>123</code> → полка → <code>456</code> → полка...",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Выход", callback_data="exit_add_mode")]]),
+        parse_mode='HTML'
+    )
+
+@callback("logs_more", needs_index=False)
+async def on_logs_more(query, context, number, page):
+    # Старая история не хранится в индексе — её читает find_logs_by_number
+    try:
+        await log_writer.flush()
+        logs = await find_logs_by_number(number)
+    except Exception as e:
+        logger.error(f"Ошибка чтения логов: {e}")
+        logs, total = log_index.history(number)
+        if not logs:
+            await query.edit_message_text("⚠️ Таблица логов не отвечает, попробуй позже.",
+                                          reply_markup=main_menu_keyboard())
+            return
+        # Хотя бы последние записи — из индекса в памяти
+        response, _ = logs_response(number, logs, total)
+        response += "\n\n🛟 <i>Таблица логов не отвечает — показаны только последние записи.</i>"
+        await query.edit_message_text(response, reply_markup=main_menu_keyboard(), parse_mode='HTML')
         return
+    total = sum(log_weight(log['action']) for log in logs)
+    response, keyboard = logs_response(number, logs, total, page)
+    await query.edit_message_text(response, reply_markup=keyboard, parse_mode='HTML')
 
-    if data == "logs_mode":
-        context.user_data.clear()
-        context.user_data["logs_mode"] = True
+@callback("shelves")
+async def on_shelves(query, context):
+    response, keyboard = shelf_summary_view()
+    await query.edit_message_text(response, reply_markup=keyboard, parse_mode='HTML')
+
+@callback("shelf")
+async def on_shelf(query, context, shelf, page):
+    response, keyboard = shelf_page_view(shelf, page)
+    await query.edit_message_text(response, reply_markup=keyboard, parse_mode='HTML')
+
+# Обработка добавления/перемещения
+@callback("add_confirm", writes=True)
+async def on_add_confirm(query, context, number, shelf):
+    user = query.from_user
+    add_date = datetime.now().strftime("%Y-%m-%d %H:%M")
+    record = inventory_add(number, shelf, add_date)
+    await log_action(context, user.id, user.username, "➕ добавление", f"Полка: {shelf}", number)
+    await query.edit_message_text(
+        f"✅ <b>{number}</b> сохранена на <b>{shelf}</b> (стр. {record['row_index']})!\n\n"
+        f"📝 Пиши следующий номер пружины:",
+        reply_markup=saved_keyboard(record),
+        parse_mode='HTML'
+    )
+
+@callback("move_confirm", writes=True)
+async def on_move_confirm(query, context, record_id, shelf):
+    user = query.from_user
+    record = spring_index.get(record_id)
+    if record is None:
+        await query.edit_message_text("⚠️ Эту строку уже удалили.", reply_markup=main_menu_keyboard())
+        return
+    number = record['number']
+    old_shelf = record['shelf']
+    inventory_move(record, shelf)
+    await log_action(context, user.id, user.username, "🔄 перемещение", f"Полка: {old_shelf} → {shelf}", number)
+    await query.edit_message_text(
+        f"✅ <b>{number}</b> перемещена!\n"
+        f"📍 {old_shelf} → <b>{shelf}</b> (стр. {record['row_index']})",
+        reply_markup=main_menu_keyboard(),
+        parse_mode='HTML'
+    )
+
+@callback("delete_last", writes=True)
+async def on_delete_last(query, context, record_id):
+    user = query.from_user
+    record = spring_index.get(record_id)
+    if record is None:
+        await query.edit_message_text("⚠️ Эту строку уже удалили.", reply_markup=main_menu_keyboard())
+        return
+    row_index = record['row_index']
+    number = record['number']
+    inventory_delete([record])
+    await log_action(context, user.id, user.username, "🗑️ удаление", f"Полка: {record['shelf']}", number)
+    await query.edit_message_text(
+        f"🗑️ <b>{number}</b> (стр. {row_index}) удалена!",
+        reply_markup=main_menu_keyboard(),
+        parse_mode='HTML'
+    )
+
+# Улучшенная навигация
+@callback("action_menu")
+async def on_action_menu(query, context, number):
+    matches = find_all_springs_by_number(number)
+    if len(matches) == 1:
+        match = matches[0]
+        response = (
+            f"🔍 <b>Пружина <code>{number}</code></b> (стр. {match['row_index']})\n\n"
+            f"📍 <b>Полка:</b> <b>{match['shelf']}</b>\n"
+            f"📅 <b>Добавлена:</b> {match['add_date']}"
+        )
+    else:
+        response = f"🔍 <b>Найдено <code>{len(matches)}</code> пружин <code>{number}</code>:</b>\n\n"
+        for i, match in enumerate(matches, 1):
+            response += (
+                f"{i}. <b>стр.{match['row_index']} {match['shelf']}</b>\n"
+                f"   📅 {match['add_date']}\n\n"
+            )
+    await query.edit_message_text(response, reply_markup=action_keyboard(number), parse_mode='HTML')
+
+@callback("delete_select")
+async def on_delete_select(query, context, number):
+    matches = find_all_springs_by_number(number)
+    if matches:
         await query.edit_message_text(
-            "📋 <b>Режим логов</b>\n\n"
-            "📝 Впиши номер пружины для просмотра истории:\n\n"
-            "Пример: <code>123</code>",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]),
+            f"🗑️ <b>Выбери строку для удаления <code>{number}</code>:</b>",
+            reply_markup=delete_keyboard(matches, number),
             parse_mode='HTML'
         )
-        return
 
-    if data == "add_spring":
-        context.user_data.clear()
-        context.user_data["add_mode"] = True
+@callback("move_select")
+async def on_move_select(query, context, number):
+    matches = find_all_springs_by_number(number)
+    if matches:
         await query.edit_message_text(
-            "➕ <b>Режим массового добавления</b>\n\n"
-            "📝 Пиши номера пружин по очереди\n"
-            "❌ <code>выход</code> - завершить\n\n"
-            "Пример: <code>123</code> → полка → <code>456</code> → полка...",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ Выход", callback_data="exit_add_mode")]]),
+            f"🔄 <b>Выбери строку для перемещения <code>{number}</code>:</b>",
+            reply_markup=move_keyboard(matches, number),
             parse_mode='HTML'
         )
-        return
 
-    # Обработка добавления/перемещения
-    if data.startswith("add_confirm:") or data.startswith("move_confirm:"):
-        parts = data.split(":", 2)
-        number = parts[1]
-        shelf_code = parts[2]
-        shelf = shelf_code.upper()
-        
-        if context.user_data.get("move_row_index"):
-            # Перемещение
-            row_index = context.user_data["move_row_index"]
-            old_shelf = context.user_data["move_old_shelf"]
-            sheet.update_cell(row_index, 2, shelf)
-            await log_action(context, user.id, user.username, "🔄 перемещение", f"Полка: {old_shelf} → {shelf}", number)
-            await query.edit_message_text(
-                f"✅ <b>{number}</b> перемещена!\n"
-                f"📍 {old_shelf} → <b>{shelf}</b> (стр. {row_index})",
-                reply_markup=main_menu_keyboard(),
-                parse_mode='HTML'
-            )
-            context.user_data.clear()
-        else:
-            # Добавление
-            sheet.append_row([number, shelf, datetime.now().strftime("%Y-%m-%d %H:%M")])
-            row_index = find_last_added_row()
-            await log_action(context, user.id, user.username, "➕ добавление", f"Полка: {shelf}", number)
-            await query.edit_message_text(
-                f"✅ <b>{number}</b> сохранена на <b>{shelf}</b> (стр. {row_index})!\n\n"
-                f"📝 Пиши следующий номер пружины:",
-                reply_markup=saved_keyboard(number),
-                parse_mode='HTML'
-            )
+@callback("del_select", writes=True)
+async def on_del_select(query, context, record_id):
+    user = query.from_user
+    record = spring_index.get(record_id)
+    if record is None:
+        await query.edit_message_text("⚠️ Эту строку уже удалили.", reply_markup=main_menu_keyboard())
         return
+    row_index = record['row_index']
+    number = record['number']
+    shelf = record['shelf'] or "❓"
+    try:
+        inventory_delete([record])
+        await log_action(context, user.id, user.username, "🗑️ удаление", f"Полка: {shelf}", number)
+        await query.edit_message_text(
+            f"✅ <b>{number}</b> (стр. {row_index}, {shelf}) удалена!",
+            reply_markup=main_menu_keyboard(),
+            parse_mode='HTML'
+        )
+    except Exception as e:
+        logger.error(f"Ошибка удаления строки {row_index}: {e}")
+        await query.edit_message_text("⚠️ Ошибка удаления.", reply_markup=main_menu_keyboard())
 
-    if data.startswith("delete_last:"):
-        number = data.split(":", 1)[1]
-        matches = find_all_springs_by_number(number)
-        if matches:
-            last_match = matches[-1]
-            row_index = last_match['row_index']
-            shelf = last_match['shelf']
-            sheet.delete_rows(row_index)
-            await log_action(context, user.id, user.username, "🗑️ удаление", f"Полка: {shelf}", number)
-            await query.edit_message_text(
-                f"🗑️ <b>{number}</b> (стр. {row_index}) удалена!",
-                reply_markup=main_menu_keyboard(),
-                parse_mode='HTML'
-            )
+@callback("move_row")
+async def on_move_row(query, context, record_id):
+    record = spring_index.get(record_id)
+    if record is None:
+        await query.edit_message_text("⚠️ Эту строку уже удалили.", reply_markup=main_menu_keyboard())
         return
+    await query.edit_message_text(
+        f"🔄 <b>{record['number']}</b> (стр. {record['row_index']}, {record['shelf']}) → <b>выбери новую полку:</b>",
+        reply_markup=shelves_keyboard("move_confirm", record_id=record['id']),
+        parse_mode='HTML'
+    )
 
-    # Улучшенная навигация
-    if data.startswith("action_menu:"):
-        number = data.split(":", 1)[1]
-        matches = find_all_springs_by_number(number)
-        if len(matches) == 1:
-            match = matches[0]
-            response = (
-                f"🔍 <b>Пружина <code>{number}</code></b> (стр. {match['row_index']})\n\n"
-                f"📍 <b>Полка:</b> <b>{match['shelf']}</b>\n"
-                f"📅 <b>Добавлена:</b> {match['add_date']}"
-            )
-        else:
-            response = f"🔍 <b>Найдено <code>{len(matches)}</code> пружин <code>{number}</code>:</b>\n\n"
-            for i, match in enumerate(matches, 1):
-                response += (
-                    f"{i}. <b>стр.{match['row_index']} {match['shelf']}</b>\n"
-                    f"   📅 {match['add_date']}\n\n"
-                )
-        await query.edit_message_text(response, reply_markup=action_keyboard(number), parse_mode='HTML')
-        return
+WARMUP_MAX_DELAY = 60
+# Снимок склада для поиска, если при запуске таблица недоступна (только режим sheets)
+INDEX_SNAPSHOT_FILE = os.getenv("INDEX_SNAPSHOT_FILE", "springs_snapshot.json")
 
-    if data.startswith("delete_select:"):
-        number = data.split(":", 1)[1]
-        matches = find_all_springs_by_number(number)
-        if matches:
-            await query.edit_message_text(
-                f"🗑️ <b>Выбери строку для удаления <code>{number}</code>:</b>",
-                reply_markup=delete_keyboard(matches, number),
-                parse_mode='HTML'
-            )
-        return
+def write_json(path, data):
+    """Записывает файл целиком или не трогает старый"""
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
 
-    if data.startswith("move_select:"):
-        number = data.split(":", 1)[1]
-        matches = find_all_springs_by_number(number)
-        if matches:
-            await query.edit_message_text(
-                f"🔄 <b>Выбери строку для перемещения <code>{number}</code>:</b>",
-                reply_markup=move_keyboard(matches, number),
-                parse_mode='HTML'
-            )
+async def save_index_snapshot():
+    if storage.name != "sheets" or not spring_index.ready or spring_index.read_only:
         return
+    try:
+        await asyncio.to_thread(write_json, INDEX_SNAPSHOT_FILE, spring_index.snapshot())
+    except OSError as e:
+        logger.error(f"Не удалось сохранить снимок склада: {e}")
 
-    if data.startswith("del_select:"):
-        parts = data.split(":", 3)
-        row_index = int(parts[1])
-        number = parts[2]
-        shelf = parts[3] if len(parts) > 3 else "❓"
+def load_index_snapshot():
+    """Поиск по снимку, пока таблица не отвечает; False, если снимка нет"""
+    if storage.name != "sheets" or not os.path.exists(INDEX_SNAPSHOT_FILE):
+        return False
+    try:
+        with open(INDEX_SNAPSHOT_FILE, encoding="utf-8") as f:
+            spring_index.load_snapshot(json.load(f))
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Снимок склада не читается: {e}")
+        return False
+    logger.warning(f"🛟 Таблица недоступна: склад открыт только для поиска по снимку от {spring_index.snapshot_time}")
+    return True
+
+async def warm_up():
+    """Загружает склад и журнал в фоне, повторяя попытки, пока Google не ответит.
+
+    Если таблица недоступна, а локальный снимок есть, поиск сразу работает
+    по снимку (только чтение), а загрузка из таблицы продолжается в фоне.
+    """
+    delay = 1
+    while not spring_index.ready or spring_index.read_only:
         try:
-            sheet.delete_rows(row_index)
-            await log_action(context, user.id, user.username, "🗑️ удаление", f"Полка: {shelf}", number)
-            await query.edit_message_text(
-                f"✅ <b>{number}</b> (стр. {row_index}, {shelf}) удалена!",
-                reply_markup=main_menu_keyboard(),
-                parse_mode='HTML'
-            )
+            all_values, ids = await storage.load_inventory()
+            spring_index.load(all_values, ids)
+            replay_sheet_journal()
+            await save_index_snapshot()
         except Exception as e:
-            logger.error(f"Ошибка удаления строки {row_index}: {e}")
-            await query.edit_message_text("⚠️ Ошибка удаления.", reply_markup=main_menu_keyboard())
-        return
+            if not spring_index.ready:
+                load_index_snapshot()
+            logger.error(f"Прогрев склада не удался, повтор через {delay} с: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARMUP_MAX_DELAY)
+    delay = 1
+    while not log_index.ready:
+        try:
+            # Блокировка журнала: пока лист читается, log_writer в него не пишет
+            async with log_index.lock:
+                log_index.load(await storage.load_logs())
+                if storage.name == "sheets":
+                    # Поиски, записанные во время загрузки, load() стёр, а в листе их ещё нет.
+                    # В SQLite они уже лежат, и load_logs() их прочитал
+                    for row in log_writer._read_spill() + log_writer.buffer:
+                        log_index.add(row)
+        except Exception as e:
+            logger.error(f"Прогрев логов не удался, повтор через {delay} с: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARMUP_MAX_DELAY)
+    if storage.name == "sheets":
+        # В режиме SQLite таблица — зеркало бота, дочитывать в ней нечего
+        log_index.start()
+    # Первое сжатие журнала — сразу после прогрева, дальше раз в LOG_COMPACT_INTERVAL
+    log_compactor._wakeup.set()
 
-    if data.startswith("move_row:"):
-        parts = data.split(":", 3)
-        row_index = int(parts[1])
-        number = parts[2]
-        old_shelf = parts[3]
-        
-        context.user_data["move_row_index"] = row_index
-        context.user_data["move_number"] = number
-        context.user_data["move_old_shelf"] = old_shelf
-        
-        await query.edit_message_text(
-            f"🔄 <b>{number}</b> (стр. {row_index}, {old_shelf}) → <b>выбери новую полку:</b>",
-            reply_markup=shelves_keyboard(number, "move"),
-            parse_mode='HTML'
+# Метрики для Prometheus: http://METRICS_LISTEN:METRICS_PORT/metrics (0 — не поднимать)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+metrics.gauge("bot_sheet_rows", lambda: len(spring_index.rows))
+metrics.gauge("bot_sheet_write_queue", lambda: len(sheet_writer.pending))
+metrics.gauge("bot_sheet_misplaced_appends", lambda: sheet_writer.misplaced_appends)
+metrics.gauge("bot_sheet_out_of_sync", lambda: int(sheet_writer.out_of_sync))
+metrics.gauge("bot_log_buffer", lambda: len(log_writer.buffer))
+metrics.gauge("bot_callback_states", lambda: len(callback_states.states))
+metrics.gauge("bot_index_ready", lambda: int(spring_index.ready))
+metrics.gauge("bot_index_read_only", lambda: int(spring_index.read_only))
+metrics.gauge("bot_sheets_circuit_open", lambda: int(sheets_io.breaker.is_open))
+
+async def serve_metrics(reader, writer):
+    """Минимальный HTTP: GET /metrics → текст Prometheus, остальное → 404"""
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.split()
+        if len(parts) > 1 and parts[1].split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n".encode() + body
         )
-        return
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+warmup_task = None
+metrics_server = None
+
+async def post_init(app):
+    global warmup_task, metrics_server
+    warmup_task = asyncio.create_task(warm_up())
+    sheet_writer.start()
+    log_writer.start()
+    log_compactor.start()
+    if METRICS_PORT:
+        try:
+            metrics_server = await asyncio.start_server(serve_metrics, METRICS_LISTEN, METRICS_PORT)
+            logger.info(f"📊 Метрики: http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.error(f"Не удалось поднять метрики на {METRICS_LISTEN}:{METRICS_PORT}: {e}")
+
+async def post_shutdown(app):
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
+    if metrics_server:
+        metrics_server.close()
+    await log_compactor.stop()
+    await sheet_writer.stop()
+    # Последний flush мог запустить сверку — при остановке она уже не нужна
+    if resync_task and not resync_task.done():
+        resync_task.cancel()
+    await log_writer.stop()
+    await log_index.stop()
+    await save_index_snapshot()
+    sheets_io.shutdown()
+    storage.close()
+
+# Режим работы: polling (по умолчанию) или webhook за reverse proxy
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8443")))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+# Для локальной проверки против поддельного Telegram: http://127.0.0.1:8081/bot
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL")
 
 def main():
     bot_token = os.getenv("BOT_TOKEN")
@@ -479,11 +2567,37 @@ def main():
         logger.error("❌ BOT_TOKEN не установлен!")
         return
 
-    app = ApplicationBuilder().token(bot_token).build()
+    builder = (
+        ApplicationBuilder()
+        .token(bot_token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL).base_file_url(TELEGRAM_BASE_URL.replace("/bot", "/file/bot"))
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("shelf", shelf_command))
+    app.add_handler(CommandHandler("stats", stats_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     app.add_handler(CallbackQueryHandler(callback_handler))
 
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            logger.error("❌ WEBHOOK_URL не установлен!")
+            return
+        logger.info(f"🤖 Бот склада пружин запущен (webhook {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH})! 🚀")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+        )
+        return
+
     logger.info("🤖 Бот склада пружин запущен! 🚀")
     app.run_polling()
 